@@ -0,0 +1,231 @@
+"""
+Micro-benchmarks for the preprocess_image operations.
+
+Runs the decode, every pipeline op and the encoders on synthetic document
+pages (several page sizes and DPIs) and on pages rendered from
+sample-data/*.pdf, timing each stage on its own and tracking its peak
+memory. With --output the results are also written as JSON, so runs from
+different commits can be compared with --compare.
+
+    python benchmarks/preprocess_benchmark.py
+    python benchmarks/preprocess_benchmark.py --dpi 300 --repeat 10 --output before.json
+    python benchmarks/preprocess_benchmark.py --output after.json --compare before.json
+
+Peak memory comes from tracemalloc, which sees NumPy arrays (including the
+arrays OpenCV returns) but not OpenCV's internal scratch buffers. It is
+measured in a separate run after the timed ones, because tracing every
+allocation slows the code down.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import platform
+import argparse
+import statistics
+import subprocess
+import tracemalloc
+
+import cv2
+import fitz
+import numpy as np
+
+# Make shared_code importable when run from the repo root
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(REPO_ROOT, "text-extraction-func"))
+
+from shared_code.utils import iter_pdf_pages  # noqa: E402
+from shared_code.preprocessing import (  # noqa: E402
+    OPERATIONS, analyze_image_quality, decode_image, encode_for_upload,
+)
+
+# Synthetic page sizes in inches
+PAGE_SIZES = {"letter": (8.5, 11), "a3": (11.7, 16.5)}
+
+# (label, op, params) for every op timed on each image
+BENCHMARK_STEPS = [
+    ("grayscale", "grayscale", {}),
+    ("gaussian_blur", "gaussian_blur", {"ksize": 5}),
+    ("median", "median", {"ksize": 3}),
+    ("threshold", "threshold", {"thresh": 150}),
+    ("threshold_otsu", "threshold", {"otsu": True}),
+    ("adaptive_threshold", "adaptive_threshold", {"block_size": 31, "c": 10}),
+    ("canny", "canny", {"low": 50, "high": 150}),
+    ("morphology_close", "morphology", {"operation": "close", "ksize": 3}),
+    ("deskew", "deskew", {}),
+    ("resize_half", "resize", {"scale": 0.5}),
+]
+
+
+def synthetic_page(width_in, height_in, dpi, seed=0):
+    """Draw a slightly skewed, noisy page of text lines as a BGR image."""
+    rng = np.random.default_rng(seed)
+    width, height = round(width_in * dpi), round(height_in * dpi)
+    page = np.full((height, width, 3), 245, np.uint8)
+    scale = dpi / 100
+    line_height = round(28 * scale)
+    margin = round(60 * scale)
+    for row, y in enumerate(range(margin, height - margin, line_height)):
+        text = " ".join(
+            "".join(chr(c) for c in rng.integers(97, 123, rng.integers(2, 9)))
+            for _ in range(12)
+        )
+        cv2.putText(page, text, (margin, y), cv2.FONT_HERSHEY_SIMPLEX, 0.6 * scale, (20, 20, 20),
+                    max(1, round(scale)), cv2.LINE_AA)
+        if row % 10 == 9:
+            cv2.rectangle(page, (margin, y + 4), (width - margin, y + 8), (0, 0, 160), -1)
+
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), 1.5, 1.0)
+    page = cv2.warpAffine(page, matrix, (width, height), borderValue=(245, 245, 245))
+    noise = rng.normal(0, 8, page.shape)
+    return np.clip(page + noise, 0, 255).astype(np.uint8)
+
+
+def measure(function, make_input, repeat):
+    """
+    Time function(make_input()) repeat times, excluding input setup, then
+    run it once more under tracemalloc for its peak memory.
+    """
+    durations = []
+    for _ in range(repeat):
+        argument = make_input()
+        started = time.perf_counter()
+        function(argument)
+        durations.append(time.perf_counter() - started)
+
+    argument = make_input()
+    tracemalloc.start()
+    try:
+        function(argument)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    median = statistics.median(durations)
+    return {
+        "median_ms": round(median * 1000, 3),
+        "min_ms": round(min(durations) * 1000, 3),
+        "ops_per_sec": round(1 / median, 2) if median else None,
+        "peak_mb": round(peak / (1024 * 1024), 2),
+    }
+
+
+def benchmark_image(name, dpi, image, repeat):
+    """Benchmark decode, every op and the encoders on one page image."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    _, png = cv2.imencode(".png", image)
+    png = png.tobytes()
+    base = {"image": name, "dpi": dpi, "width": image.shape[1], "height": image.shape[0],
+            "input_bytes": len(png)}
+
+    stages = [
+        ("decode", "decode_color", lambda data: decode_image(data, "rgb"), lambda: png),
+        ("decode", "decode_gray", lambda data: decode_image(data, "gray"), lambda: png),
+        ("analyze", "analyze_quality", analyze_image_quality, lambda: gray),
+    ]
+    for label, op, params in BENCHMARK_STEPS:
+        function = OPERATIONS[op][0]
+        source = image if op == "grayscale" else gray
+        # Ops may work in place, so each run gets a fresh copy
+        stages.append((
+            "op", label,
+            lambda array, function=function, params=params: function(array, **params),
+            lambda source=source: source.copy(),
+        ))
+    binary = cv2.threshold(gray, 150, 255, cv2.THRESH_BINARY)[1]
+    stages += [
+        ("encode", "png", lambda array: cv2.imencode(".png", array), lambda: gray),
+        ("encode", "upload_gray", lambda array: encode_for_upload(array), lambda: gray),
+        ("encode", "upload_binary", lambda array: encode_for_upload(array), lambda: binary),
+    ]
+
+    results = []
+    for stage, label, function, make_input in stages:
+        result = dict(base, stage=stage, name=label, **measure(function, make_input, repeat))
+        results.append(result)
+        print(f"{name:>28} {dpi:>4}dpi {stage:>8} {label:<20} "
+              f"{result['median_ms']:>9.2f} ms {result['ops_per_sec']:>8} ops/s "
+              f"{result['peak_mb']:>7.1f} MB")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Print the median-time ratio of every stage against a previous run."""
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    key = lambda result: (result["image"], result["dpi"], result["stage"], result["name"])
+    previous = {key(result): result for result in baseline["results"]}
+    print(f"\nCompared with {baseline_path} (commit {baseline['meta'].get('commit')}):")
+    for result in results:
+        before = previous.get(key(result))
+        if before and before["median_ms"]:
+            ratio = result["median_ms"] / before["median_ms"]
+            flag = "  <-- slower" if ratio > 1.1 else ""
+            print(f"{result['image']:>28} {result['dpi']:>4}dpi {result['name']:<20} "
+                  f"{before['median_ms']:>9.2f} -> {result['median_ms']:>9.2f} ms "
+                  f"(x{ratio:.2f}){flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark preprocess_image operations")
+    parser.add_argument("--dpi", type=int, nargs="+", default=[150, 200, 300],
+                        help="DPIs for synthetic pages and PDF renders")
+    parser.add_argument("--sizes", nargs="+", default=["letter"], choices=sorted(PAGE_SIZES),
+                        help="Synthetic page sizes")
+    parser.add_argument("--pdfs", default=os.path.join(REPO_ROOT, "sample-data", "*.pdf"),
+                        help="Glob of PDFs to render pages from ('' to skip)")
+    parser.add_argument("--pdf-pages", type=int, default=1, help="Pages to render per PDF")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per stage")
+    parser.add_argument("--output", help="JSON results file (default: print only)")
+    parser.add_argument("--compare", help="Previous results file to compare against")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        for dpi in args.dpi:
+            image = synthetic_page(*PAGE_SIZES[size], dpi)
+            results += benchmark_image(f"synthetic-{size}", dpi, image, args.repeat)
+
+    for pdf_path in sorted(glob.glob(args.pdfs)) if args.pdfs else []:
+        for dpi in args.dpi:
+            pages = iter_pdf_pages(pdf_path, dpi=dpi, max_pages=args.pdf_pages, use_cache=False)
+            for page_number, image_bytes, _ in pages:
+                image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+                name = f"{os.path.basename(pdf_path)}#{page_number}"
+                results += benchmark_image(name, dpi, image, args.repeat)
+
+    output = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "pymupdf": fitz.VersionBind,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(output, output_file, indent=2)
+        print(f"\nWrote {len(results)} results to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,10 @@ import json
 import logging
 import base64
 import azure.functions as func
-from azure.ai.formrecognizer import DocumentAnalysisClient
-from azure.core.credentials import AzureKeyCredential
-from shared_code.utils import (
-    save_bytes_to_temp_file,
-    DOCUMENT_INTELLIGENCE_ENDPOINT,
-    DOCUMENT_INTELLIGENCE_KEY,
-)
+from shared_code.document_intelligence import analyze_layout_async
 
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info(
         "Python HTTP trigger function processed a request to analyze document layout."
     )
@@ -29,67 +23,8 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 mimetype="application/json",
             )
 
-        # Decode base64 image
-        image_bytes = base64.b64decode(image_data)
-
-        # Save image to temp file
-        image_path = save_bytes_to_temp_file(image_bytes, suffix=".png")
-
-        # Initialize Azure Document Intelligence client
-        client = DocumentAnalysisClient(
-            DOCUMENT_INTELLIGENCE_ENDPOINT,
-            AzureKeyCredential(DOCUMENT_INTELLIGENCE_KEY),
-        )
-
-        # Analyze the document layout
-        with open(image_path, "rb") as image_file:
-            poller = client.begin_analyze_document("prebuilt-layout", image_file)
-            result = poller.result()
-
-        # Extract and format result
-        layout_result = {"pages": [], "tables": []}
-
-        for page in result.pages:
-            page_info = {
-                "page_number": page.page_number,
-                "width": page.width,
-                "height": page.height,
-                "unit": page.unit,
-                "lines": [],
-            }
-
-            for line in page.lines:
-                line_info = {
-                    "text": line.content,
-                    "bounding_regions": [
-                        {"offset": span.offset, "length": span.length}
-                        for span in (line.spans or [])
-                    ],
-                }
-                page_info["lines"].append(line_info)
-
-            layout_result["pages"].append(page_info)
-
-        for table in result.tables:
-            table_info = {
-                "row_count": table.row_count,
-                "column_count": table.column_count,
-                "cells": [],
-            }
-
-            for cell in table.cells:
-                cell_info = {
-                    "row_index": cell.row_index,
-                    "column_index": cell.column_index,
-                    "text": cell.content,
-                    "bounding_regions": [
-                        {"offset": span.offset, "length": span.length}
-                        for span in (cell.spans or [])
-                    ],
-                }
-                table_info["cells"].append(cell_info)
-
-            layout_result["tables"].append(table_info)
+        # Analyze the decoded image in memory with prebuilt-layout
+        layout_result = await analyze_layout_async(base64.b64decode(image_data))
 
         return func.HttpResponse(
             json.dumps(
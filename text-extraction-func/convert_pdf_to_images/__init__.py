@@ -1,34 +1,80 @@
 import json
 import logging
 import base64
+import time
+import uuid
+import tarfile
+import zipfile
+from io import BytesIO
 import azure.functions as func
 from shared_code.utils import (
-    save_bytes_to_temp_file,
+    IMAGE_FORMATS,
     create_temp_directory,
-    cleanup_temp_files,
     convert_pdf_to_images,
+    iter_pdf_pages,
+    validate_image_format,
+    validate_colorspace,
 )
 
+# Media types that can be requested with the Accept header instead of JSON
+MULTIPART_MIXED = "multipart/mixed"
+TAR_ARCHIVE = "application/x-tar"
+ZIP_ARCHIVE = "application/zip"
+BINARY_RESPONSE_TYPES = (MULTIPART_MIXED, TAR_ARCHIVE, ZIP_ARCHIVE)
+
 def main(req: func.HttpRequest) -> func.HttpResponse:
     """
     Azure Function HTTP trigger that converts a PDF file to a collection of images.
     
     This function:
     1. Extracts a PDF file from the request body
-    2. Converts each page to a PNG image
-    3. Returns both file paths and base64-encoded image data
+    2. Converts each page to an image in memory, encoding it exactly once
+    3. Returns base64-encoded image data (and file paths if save_images is set)
     
     Parameters:
         req (func.HttpRequest): The HTTP request containing the PDF file in the body
+        
+    Options (JSON body fields, or query parameters for raw PDF uploads):
+        image_format: "png" (default), "jpeg", "webp" or "tiff-g4" (bilevel)
+        compression_level: PNG zlib level 0-9
+        quality: JPEG/WebP quality 1-100
+        workers: Number of processes used to render pages (default and maximum
+            PDF_RENDER_WORKERS, also capped at the CPU count)
+        encode_workers: Threads encoding pages while the next ones render in this
+            process (default PDF_ENCODE_WORKERS, 0 = off)
+        queue_depth: Pages rendered ahead when encode_workers is set (default PDF_PIPELINE_DEPTH)
+        save_images: Also write the images to a temporary folder (default false)
+        pages: Pages to render, as a list or a string such as "1-3,10" (default all)
+        max_pages: Render at most this many of the selected pages
+        use_cache: Look pages up in the render cache first (default true)
+        dpi: Rendering resolution (default 300)
+        max_pixels: Per-page pixel budget; oversized pages are rendered at a lower DPI
+        min_dpi: Lowest DPI the pixel budget may push a page down to
+        colorspace: "rgb" (default), "gray" or "bilevel"; gray and bilevel render
+            directly in grayscale without alpha
+        extract_images: Return the embedded image of scanned pages that are a
+            single full-page JPEG/PNG image as stored, instead of rendering them
+            (default false); those pages keep their own format and resolution
+    
+    Response format is negotiated with the Accept header. JSON with base64
+    images is the default; binary alternatives avoid the base64 and JSON
+    overhead (save_images is ignored for them):
+        multipart/mixed: one binary part per page, then a JSON manifest part
+        application/x-tar or application/zip: uncompressed archive with one
+            file per page plus manifest.json
     
     Returns:
         func.HttpResponse: JSON response containing:
             - success message with page count
-            - total image count
-            - list of images with page numbers and base64-encoded data
+            - total image count (pages in the document) and rendered image count
+            - render cache hits and misses for this request
+            - output format, MIME type and colorspace of the images
+            - list of images with page numbers, the DPI each page was rendered at,
+              pixel size, format, whether it was extracted and base64-encoded data
+            - image_paths of the saved images (only if save_images is set)
             
     Error responses:
-        - 400 Bad Request: If no PDF is provided
+        - 400 Bad Request: If no PDF is provided, or the output options or page selection are invalid
         - 500 Internal Server Error: For processing failures
     """
     logging.info(
@@ -36,6 +82,8 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     )
 
     try:
+        req_body = None
+        
         # Try to get JSON data first
         try:
             req_body = req.get_json()
@@ -57,30 +105,98 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 mimetype="application/json",
             )
 
-        # Save PDF to temp file
-        pdf_path = save_bytes_to_temp_file(pdf_bytes)
-        
-        # Create temporary directory for output images (optional)
-        output_folder = create_temp_directory()
-
-        # Convert PDF to images with base64 encoding
-        result = convert_pdf_to_images(
-            pdf_path, 
-            output_folder=output_folder,
-            return_base64=True
-        )
+        # Get output encoding options
+        try:
+            image_format = get_option(req, req_body, "image_format", "png").lower()
+            compression_level = get_option(req, req_body, "compression_level", None, int)
+            quality = get_option(req, req_body, "quality", None, int)
+            workers = get_option(req, req_body, "workers", None, int)
+            encode_workers = get_option(req, req_body, "encode_workers", None, int)
+            queue_depth = get_option(req, req_body, "queue_depth", None, int)
+            if (encode_workers is not None and encode_workers < 0) or (
+                queue_depth is not None and queue_depth < 1
+            ):
+                raise ValueError("encode_workers must be >= 0 and queue_depth >= 1")
+            save_images = get_option(req, req_body, "save_images", False, parse_bool)
+            pages = get_option(req, req_body, "pages", None)
+            max_pages = get_option(req, req_body, "max_pages", None, int)
+            use_cache = get_option(req, req_body, "use_cache", True, parse_bool)
+            dpi = get_option(req, req_body, "dpi", 300, float)
+            max_pixels = get_option(req, req_body, "max_pixels", None, int)
+            min_dpi = get_option(req, req_body, "min_dpi", None, float)
+            colorspace = get_option(req, req_body, "colorspace", "rgb").lower()
+            extract_images = get_option(req, req_body, "extract_images", False, parse_bool)
+            validate_colorspace(colorspace)
+            if dpi <= 0 or (min_dpi is not None and min_dpi <= 0):
+                raise ValueError("dpi and min_dpi must be positive")
+            if max_pixels is not None and max_pixels <= 0:
+                raise ValueError("max_pixels must be positive")
+            validate_image_format(image_format, compression_level, quality)
+        except ValueError as e:
+            return func.HttpResponse(
+                json.dumps({"error": str(e)}),
+                status_code=400,
+                mimetype="application/json",
+            )
+
+        render_options = {
+            "image_format": image_format,
+            "compression_level": compression_level,
+            "quality": quality,
+            "workers": workers,
+            "encode_workers": encode_workers,
+            "queue_depth": queue_depth,
+            "pages": pages,
+            "max_pages": max_pages,
+            "use_cache": use_cache,
+            "dpi": dpi,
+            "max_pixels": max_pixels,
+            "min_dpi": min_dpi,
+            "colorspace": colorspace,
+            "extract_images": extract_images,
+        }
+        response_type = negotiate_response_type(req.headers.get("Accept"))
+
+        try:
+            if response_type in BINARY_RESPONSE_TYPES:
+                # Stream rendered pages straight into the binary body, no base64
+                return binary_response(
+                    response_type, iter_pdf_pages(pdf_bytes, **render_options), image_format
+                )
+
+            # Only touch the disk when the caller asks for image files
+            output_folder = create_temp_directory() if save_images else None
+
+            # Convert PDF to images with base64 encoding, opening the PDF from memory
+            result = convert_pdf_to_images(
+                pdf_bytes,
+                output_folder=output_folder,
+                return_base64=True,
+                **render_options,
+            )
+        except ValueError as e:
+            # Page selection is validated once the page count is known
+            return func.HttpResponse(
+                json.dumps({"error": str(e)}),
+                status_code=400,
+                mimetype="application/json",
+            )
 
-        # Clean up the temporary PDF file
-        cleanup_temp_files([pdf_path])
+        response = {
+            "message": f"Converted {result['rendered_count']} of {result['image_count']} pages to images",
+            "image_count": result['image_count'],
+            "rendered_count": result['rendered_count'],
+            "cache": result['cache'],
+            "image_format": result['image_format'],
+            "mimetype": result['mimetype'],
+            "colorspace": result['colorspace'],
+            "images": result['image_data'],
+        }
+        if save_images:
+            response["image_paths"] = result['image_paths']
 
         return func.HttpResponse(
-            json.dumps(
-                {
-                    "message": f"Converted {result['image_count']} pages to images",
-                    "image_count": result['image_count'],
-                    "images": result['image_data'],
-                }
-            ),
+            json.dumps(response),
             mimetype="application/json",
         )
 
@@ -91,3 +207,134 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500, 
             mimetype="application/json"
         )
+
+
+def get_option(req, req_body, name, default=None, convert=None):
+    """Read an option from the JSON body, falling back to the query string."""
+    value = None
+    if req_body:
+        value = req_body.get(name)
+    if value is None:
+        value = req.params.get(name)
+    if value is None:
+        return default
+    return convert(value) if convert else value
+
+
+def parse_bool(value):
+    """Parse a boolean option given as a JSON boolean or a query-string value."""
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+def negotiate_response_type(accept):
+    """Pick the response media type from an Accept header; JSON unless a binary type wins."""
+    best_type, best_quality = "application/json", 0.0
+    for item in (accept or "").split(","):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        media_type = media_type.lower()
+        if media_type == "application/tar":
+            media_type = TAR_ARCHIVE
+        
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        
+        if media_type == "application/json" and quality >= best_quality:
+            best_type, best_quality = media_type, quality
+        elif media_type in BINARY_RESPONSE_TYPES and quality > best_quality:
+            best_type, best_quality = media_type, quality
+    return best_type
+
+
+def binary_response(response_type, rendered_pages, image_format):
+    """
+    Build a multipart/mixed or archive response with one binary image per page.
+    
+    Pages are written into the body as they are rendered; a JSON manifest
+    (page numbers, file names, DPI and size per page, cache counters) is
+    added last because the counts are only known at the end.
+    """
+    body = BytesIO()
+    boundary = uuid.uuid4().hex
+    archive = None
+    if response_type == TAR_ARCHIVE:
+        # Stream mode writes each member sequentially without seeking back
+        archive = tarfile.open(fileobj=body, mode="w|")
+    elif response_type == ZIP_ARCHIVE:
+        archive = zipfile.ZipFile(body, "w", compression=zipfile.ZIP_STORED)
+
+    def add_entry(filename, content_type, payload, headers=None):
+        if response_type == MULTIPART_MIXED:
+            part_headers = {
+                "Content-Type": content_type,
+                "Content-Disposition": f'attachment; filename="{filename}"',
+                "Content-Length": str(len(payload)),
+                **(headers or {}),
+            }
+            body.write(f"--{boundary}\r\n".encode())
+            for name, value in part_headers.items():
+                body.write(f"{name}: {value}\r\n".encode())
+            body.write(b"\r\n")
+            body.write(payload)
+            body.write(b"\r\n")
+        elif response_type == TAR_ARCHIVE:
+            member = tarfile.TarInfo(filename)
+            member.size = len(payload)
+            member.mtime = int(time.time())
+            archive.addfile(member, BytesIO(payload))
+        else:
+            archive.writestr(filename, payload)
+
+    manifest = {
+        "image_count": 0,
+        "rendered_count": 0,
+        "cache": {"hits": 0, "misses": 0},
+        "image_format": image_format,
+        "mimetype": IMAGE_FORMATS[image_format]["mimetype"],
+        "images": [],
+    }
+    for page_number, image_bytes, metadata in rendered_pages:
+        filename = f"page_{page_number}{IMAGE_FORMATS[metadata['format']]['extension']}"
+        add_entry(filename, metadata["mimetype"], image_bytes, {"X-Page-Number": str(page_number)})
+        manifest["image_count"] = metadata["page_count"]
+        manifest["rendered_count"] += 1
+        manifest["cache"]["hits" if metadata["cached"] else "misses"] += 1
+        manifest["images"].append({
+            "page_number": page_number,
+            "filename": filename,
+            "dpi": metadata["dpi"],
+            "colorspace": metadata["colorspace"],
+            "width": metadata["width"],
+            "height": metadata["height"],
+            "format": metadata["format"],
+            "extracted": metadata["extracted"],
+        })
+
+    add_entry("manifest.json", "application/json", json.dumps(manifest).encode())
+    if archive is not None:
+        archive.close()
+    else:
+        body.write(f"--{boundary}--\r\n".encode())
+
+    # getvalue() hands over the BytesIO buffer itself rather than a copy, as
+    # long as no getbuffer() view is open and nothing is written afterwards.
+    # HttpResponse keeps a bytes body as is; it rejects a memoryview and
+    # copies a bytearray, so bytes is the one type that is not copied again
+    payload = body.getvalue()
+    body.close()
+
+    headers = {"Content-Type": response_type}
+    if response_type == MULTIPART_MIXED:
+        headers["Content-Type"] = f"{MULTIPART_MIXED}; boundary={boundary}"
+    return func.HttpResponse(
+        payload,
+        mimetype=response_type,
+        headers=headers,
+    )
@@ -22,14 +22,14 @@ def convert_pdf_to_images(req: func.HttpRequest) -> func.HttpResponse:
 
 # Add decorators for your other functions
 @app.route(route="analyze_document", auth_level=func.AuthLevel.ANONYMOUS, methods=["GET", "POST"])
-def analyze_document(req: func.HttpRequest) -> func.HttpResponse:
+async def analyze_document(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Function2 processed a request.')
-    return analyze_document_func(req)
+    return await analyze_document_func(req)
 
 @app.route(route="analyze_layout", auth_level=func.AuthLevel.ANONYMOUS, methods=["POST"])
-def analyze_layout(req: func.HttpRequest) -> func.HttpResponse:
+async def analyze_layout(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Function3 processed a request.')
-    return analyze_layout_func(req)
+    return await analyze_layout_func(req)
 
 @app.route(route="preprocess_image", auth_level=func.AuthLevel.ANONYMOUS, methods=["GET", "POST"])
 def preprocess_image(req: func.HttpRequest) -> func.HttpResponse:
@@ -37,8 +37,8 @@ def preprocess_image(req: func.HttpRequest) -> func.HttpResponse:
     return preprocess_image_func(req)
 
 @app.route(route="process_document", auth_level=func.AuthLevel.ANONYMOUS, methods=["GET", "POST"])
-def process_document(req: func.HttpRequest) -> func.HttpResponse:
+async def process_document(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Function4 processed a request.')
-    return process_document_func(req)
+    return await process_document_func(req)
 
 
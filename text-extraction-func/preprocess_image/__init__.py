@@ -1,20 +1,59 @@
 
 import json
-import logging
-from io import BytesIO
 import base64
-import cv2
-import numpy as np
+import logging
 import azure.functions as func
-from shared_code.utils import save_bytes_to_temp_file
+from shared_code.preprocessing import (
+    compile_pipeline, preprocess_image_bytes, preprocess_image_data, preprocess_batch
+)
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request to preprocess an image.')
-    
+
     try:
         # Parse request body
         req_body = req.get_json()
-        
+
+        # Get preprocessing options: an ordered "pipeline" of ops, or the
+        # legacy apply_* booleans
+        options = req_body.get('options', {})
+        try:
+            pipeline = compile_pipeline(options)
+        except ValueError as e:
+            return func.HttpResponse(
+                json.dumps({"error": str(e)}),
+                status_code=400,
+                mimetype="application/json"
+            )
+
+        # Batch form: a list of images preprocessed concurrently in one call
+        images = req_body.get('images')
+        if images is not None:
+            if not isinstance(images, list):
+                return func.HttpResponse(
+                    json.dumps({"error": "images must be a list"}),
+                    status_code=400,
+                    mimetype="application/json"
+                )
+            # Threads for the batch; capped at PREPROCESS_WORKERS in preprocess_batch
+            max_workers = req_body.get('max_workers')
+            if max_workers is not None and (
+                not isinstance(max_workers, int) or isinstance(max_workers, bool) or max_workers < 1
+            ):
+                return func.HttpResponse(
+                    json.dumps({"error": f"max_workers must be a positive integer, got {max_workers!r}"}),
+                    status_code=400,
+                    mimetype="application/json"
+                )
+            results = preprocess_batch(images, options, max_workers, pipeline)
+            return func.HttpResponse(
+                json.dumps({
+                    "message": f"Preprocessed {sum('error' not in r for r in results)} of {len(results)} images",
+                    "results": results
+                }),
+                mimetype="application/json"
+            )
+
         # Get the image as base64 string
         image_data = req_body.get('image_data')
         if not image_data:
@@ -23,59 +62,44 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=400,
                 mimetype="application/json"
             )
-        
-        # Get preprocessing options
-        options = req_body.get('options', {})
-        apply_grayscale = options.get('apply_grayscale', False)
-        apply_blur = options.get('apply_blur', False)
-        apply_threshold = options.get('apply_threshold', False)
-        apply_edge_detection = options.get('apply_edge_detection', False)
-        
-        # Decode base64 image
-        image_bytes = base64.b64decode(image_data)
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        # Apply preprocessing steps based on options
-        processed_image = image.copy()
-        
-        if apply_grayscale:
-            processed_image = cv2.cvtColor(processed_image, cv2.COLOR_BGR2GRAY)
-            
-        if apply_blur:
-            # Ensure image is grayscale for blur
-            if len(processed_image.shape) == 3:
-                processed_image = cv2.cvtColor(processed_image, cv2.COLOR_BGR2GRAY)
-            processed_image = cv2.GaussianBlur(processed_image, (5, 5), 0)
-            
-        if apply_threshold:
-            # Ensure image is grayscale for threshold
-            if len(processed_image.shape) == 3:
-                processed_image = cv2.cvtColor(processed_image, cv2.COLOR_BGR2GRAY)
-            _, processed_image = cv2.threshold(processed_image, 150, 255, cv2.THRESH_BINARY)
-            
-        if apply_edge_detection:
-            # Ensure image is grayscale for edge detection
-            if len(processed_image.shape) == 3:
-                processed_image = cv2.cvtColor(processed_image, cv2.COLOR_BGR2GRAY)
-            processed_image = cv2.Canny(processed_image, 50, 150)
-        
-        # Encode the processed image to base64
-        _, buffer = cv2.imencode('.png', processed_image)
-        processed_image_data = base64.b64encode(buffer).decode('utf-8')
-        
+
+        try:
+            if wants_binary(req, req_body):
+                # Send the encoded image as the body, skipping base64 and JSON
+                image_bytes, report = preprocess_image_bytes(base64.b64decode(image_data), pipeline)
+                return func.HttpResponse(
+                    body=image_bytes,
+                    mimetype=report.get("mimetype", "application/octet-stream"),
+                    headers={"X-Preprocess-Report": json.dumps(report)}
+                )
+            result = preprocess_image_data(image_data, pipeline)
+        except ValueError as e:
+            return func.HttpResponse(
+                json.dumps({"error": str(e)}),
+                status_code=400,
+                mimetype="application/json"
+            )
+
         return func.HttpResponse(
             json.dumps({
                 "message": "Image preprocessed successfully",
-                "processed_image": processed_image_data
+                **result
             }),
             mimetype="application/json"
         )
-    
+
     except Exception as e:
         logging.error(f"Error preprocessing image: {str(e)}")
         return func.HttpResponse(
             json.dumps({"error": str(e)}),
             status_code=500,
             mimetype="application/json"
-        )
\ No newline at end of file
+        )
+
+
+def wants_binary(req, req_body):
+    """Whether the processed image should be the raw response body instead of base64 JSON."""
+    if req_body.get('response') == 'binary':
+        return True
+    accept = (req.headers.get('accept') or '').split(',')[0].split(';')[0].strip().lower()
+    return accept.startswith('image/') or accept == 'application/octet-stream'
@@ -2,11 +2,24 @@ import json
 import logging
 import base64
 import os
-import requests
+import asyncio
 import azure.functions as func
+from shared_code.utils import (
+    iter_pdf_pages, triage_pdf_pages, split_pdf, open_pdf, parse_page_selection
+)
+from shared_code.preprocessing import (
+    compile_pipeline, iter_preprocessed_pages, validate_upload_options, fit_image_data
+)
+from shared_code.stages import get_stage_runner
+from shared_code.document_intelligence import merge_results, plan_analyses, layout_from_document
 
+# Pages of one document processed at the same time
+PROCESS_DOCUMENT_CONCURRENCY = int(os.getenv("PROCESS_DOCUMENT_CONCURRENCY", "4"))
+# Pages sent per preprocess_image batch call
+PREPROCESS_BATCH_SIZE = int(os.getenv("PREPROCESS_BATCH_SIZE", "8"))
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request to process a document.')
     
     try:
@@ -19,12 +32,70 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         preprocess_images = options.get('preprocess_images', False)
         analyze_layout = options.get('analyze_layout', False)
         analyze_content = options.get('analyze_content', True)
-        
+        # Render pages in-process one at a time instead of converting the
+        # whole PDF up front through the convert_pdf_to_images endpoint
+        stream_pages = options.get('stream_pages', False)
+        # Streamed pages are preprocessed in-process as they are rendered
+        fused_preprocessing = convert_pdf and stream_pages and preprocess_images
+        # PDF conversion settings: page selection such as "1-3,10", the
+        # adaptive DPI budget, the render colorspace and whether scanned
+        # pages pass on their embedded image (see convert_pdf_to_images)
+        conversion_options = {
+            key: options[key]
+            for key in ('pages', 'max_pages', 'max_pixels', 'min_dpi', 'colorspace', 'extract_images')
+            if options.get(key) is not None
+        }
+        # Send the PDF itself to Document Intelligence in sub-PDFs of
+        # pdf_chunk_pages pages instead of one rendered image per page
+        submit_pdf = convert_pdf and options.get('submit_pdf', False)
+        # Read pages with a usable text layer straight from the PDF; only
+        # image-only pages are rasterized and sent to Document Intelligence
+        detect_text_layer = options.get('detect_text_layer', False)
+        # Downscale/re-encode pages before they are sent to Document
+        # Intelligence: max_edge, target_dpi, max_bytes (see encode_for_upload)
+        upload_options = options.get('upload')
+        # Skip Document Intelligence for pages auto preprocessing flags as
+        # blank; off by default, as a missed page loses its content
+        skip_blank_pages = options.get('skip_blank_pages', False)
+        # Run the stages in-process ("local", default PROCESS_DOCUMENT_STAGES)
+        # or through their HTTP endpoints ("http")
+        stage_mode = options.get('stage_mode')
+        try:
+            if submit_pdf and preprocess_images:
+                raise ValueError("submit_pdf sends the PDF as is and can not be combined with preprocess_images")
+            if submit_pdf and upload_options is not None:
+                raise ValueError("submit_pdf sends the PDF as is and can not be combined with upload")
+            if upload_options is not None:
+                validate_upload_options(upload_options)
+            # Pages processed at the same time and pages per preprocess_image
+            # batch; both hold pages in memory, so requests can only lower them
+            max_concurrency = get_limit(options, 'max_concurrency', PROCESS_DOCUMENT_CONCURRENCY)
+            preprocess_batch_size = get_limit(options, 'preprocess_batch_size', PREPROCESS_BATCH_SIZE)
+            stages = get_stage_runner(stage_mode, get_base_url(req))
+        except ValueError as e:
+            return func.HttpResponse(
+                json.dumps({"error": str(e)}),
+                status_code=400,
+                mimetype="application/json"
+            )
         # Get the model to use for document analysis
         model = req_body.get('model', 'prebuilt-document')
+        # Make one call per page when the model's result also gives the
+        # layout view, unless derive_layout is turned off
+        plan = plan_analyses(
+            analyze_layout, analyze_content, model, options.get('derive_layout', True)
+        )
         
         # Get preprocessing options
         preprocessing_options = req_body.get('preprocessing_options', {})
+        if preprocess_images and upload_options and 'upload' not in preprocessing_options:
+            # Fit pages for upload in the preprocessing encode, not a second pass
+            preprocessing_options = dict(preprocessing_options, upload=upload_options)
+        if convert_pdf and 'colorspace' in conversion_options:
+            # Let preprocessing skip color decoding and conversions for gray renders
+            preprocessing_options = dict(
+                preprocessing_options, input_colorspace=conversion_options['colorspace']
+            )
         
         # Get file data (PDF or image)
         file_data = req_body.get('file_data')
@@ -35,13 +106,77 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 mimetype="application/json"
             )
             
-        base_url = get_base_url(req)
-        results = {}
+        results = {"analysis_plan": plan}
+        page_results = []
+        triage_by_page = {}
+        pdf_bytes = base64.b64decode(file_data) if convert_pdf else None
+        
+        # Check the page selection up front, as convert_pdf_to_images does;
+        # streamed and converted pages would only fail on it later, with a 500
+        if convert_pdf and ('pages' in conversion_options or 'max_pages' in conversion_options):
+            try:
+                check_page_selection(
+                    pdf_bytes, conversion_options.get('pages'), conversion_options.get('max_pages')
+                )
+            except ValueError as e:
+                return func.HttpResponse(
+                    json.dumps({"error": str(e)}),
+                    status_code=400,
+                    mimetype="application/json"
+                )
+        
+        # Triage PDF pages: born-digital pages skip rasterization and OCR
+        if convert_pdf and detect_text_layer:
+            ocr_pages = []
+            for decision in await asyncio.to_thread(
+                triage_pdf_pages,
+                pdf_bytes, conversion_options.get('pages'), conversion_options.get('max_pages')
+            ):
+                content = decision.pop('content', None)
+                triage_by_page[decision['page_number']] = decision
+                if content is None:
+                    ocr_pages.append(decision['page_number'])
+                    continue
+                
+                page_result = {"page_number": decision['page_number'], "triage": decision}
+                if analyze_layout:
+                    page_result['layout'] = layout_from_document(content)
+                if analyze_content:
+                    page_result['content'] = content
+                page_results.append(page_result)
+            
+            conversion_options = dict(conversion_options, pages=ocr_pages)
+            conversion_options.pop('max_pages', None)
         
         # Convert PDF to images if needed
-        if convert_pdf:
-            pdf_bytes = base64.b64decode(file_data)
-            pdf_response = convert_pdf_to_images(base_url, pdf_bytes)
+        if convert_pdf and triage_by_page and not conversion_options['pages']:
+            # Every page was read from its text layer
+            images = []
+        elif submit_pdf:
+            try:
+                chunks = await asyncio.to_thread(
+                    split_pdf, pdf_bytes, conversion_options.get('pages'),
+                    conversion_options.get('max_pages'), options.get('pdf_chunk_pages')
+                )
+            except ValueError as e:
+                return func.HttpResponse(
+                    json.dumps({"error": str(e)}),
+                    status_code=400,
+                    mimetype="application/json"
+                )
+            results['document'] = await analyze_pdf_chunks(stages, chunks, model, plan, max_concurrency)
+            images = []
+        elif fused_preprocessing:
+            # Render and preprocess each page in-process; pages are encoded once
+            results['pdf_conversion'] = {"image_count": 0}
+            images = stream_preprocessed_pages(
+                pdf_bytes, results['pdf_conversion'], conversion_options, preprocessing_options
+            )
+        elif convert_pdf and stream_pages:
+            results['pdf_conversion'] = {"image_count": 0}
+            images = stream_pdf_pages(pdf_bytes, results['pdf_conversion'], conversion_options)
+        elif convert_pdf:
+            pdf_response = await stages.convert_pdf_async(pdf_bytes, conversion_options)
             
             if 'error' in pdf_response:
                 return func.HttpResponse(
@@ -56,44 +191,28 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             # If not converting PDF, treat file_data as single image
             images = [{"page_number": 1, "image_data": file_data}]
             
-        # Process each image
-        page_results = []
-        for image in images:
-            page_number = image['page_number']
-            image_data = image['image_data']
-            page_result = {"page_number": page_number}
-            
-            # Preprocess image if needed
-            if preprocess_images:
-                preprocessed = preprocess_image(base_url, image_data, preprocessing_options)
-                
-                if 'error' in preprocessed:
-                    page_result['preprocessing_error'] = preprocessed['error']
-                else:
-                    page_result['preprocessing'] = "success"
-                    image_data = preprocessed.get('processed_image', image_data)
-            
-            # Analyze layout if needed
-            if analyze_layout:
-                layout = analyze_document_layout(base_url, image_data)
-                
-                if 'error' in layout:
-                    page_result['layout_error'] = layout['error']
-                else:
-                    page_result['layout'] = layout.get('result', {})
-            
-            # Analyze content if needed
-            if analyze_content:
-                content = analyze_document_content(base_url, image_data, model)
-                
-                if 'error' in content:
-                    page_result['content_error'] = content['error']
-                else:
-                    page_result['content'] = content.get('result', {})
+        # Preprocess images in batches if needed
+        if preprocess_images and not fused_preprocessing:
+            images = preprocess_pages(stages, images, preprocessing_options, preprocess_batch_size)
+        elif not preprocess_images:
+            images = ((image, None) for image in images)
             
+        # Process pages concurrently on the event loop; pages keep coming from
+        # the (possibly streaming) source while earlier ones wait on Document
+        # Intelligence
+        process = lambda image, preprocessed: process_page(
+            stages, image, preprocessed, model, plan, upload_options, skip_blank_pages
+        )
+        async for (image, _), page_result in iter_concurrent(process, images, max_concurrency):
+            if image['page_number'] in triage_by_page:
+                page_result = {
+                    "page_number": image['page_number'],
+                    "triage": triage_by_page[image['page_number']],
+                    **page_result
+                }
             page_results.append(page_result)
             
-        results['pages'] = page_results
+        results['pages'] = sorted(page_results, key=lambda page: page['page_number'])
         
         return func.HttpResponse(
             json.dumps(results),
@@ -108,61 +227,245 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             mimetype="application/json"
         )
 
+async def process_page(stages, image, preprocessed, model, plan, upload_options=None,
+                       skip_blank_pages=False):
+    """
+    Run the per-page stages on one (image, preprocessed) pair and return its page result.
+
+    The Document Intelligence calls of the plan (see plan_analyses) are
+    awaited together. Failures are kept on the page as *_error entries or
+    as error.
+    """
+    page_result = {"page_number": image['page_number']}
+    try:
+        image_data = image['image_data']
+        
+        # Use the preprocessed image if preprocessing succeeded
+        if preprocessed is not None:
+            if 'error' in preprocessed:
+                page_result['preprocessing_error'] = preprocessed['error']
+            else:
+                page_result['preprocessing'] = "success"
+                image_data = preprocessed.get('processed_image', image_data)
+                if 'quality' in preprocessed:
+                    page_result['quality'] = preprocessed['quality']
+            
+            # Auto preprocessing found nothing on the page; skip analysis
+            # only if the caller asked for it
+            if preprocessed.get('blank'):
+                page_result['blank'] = True
+                if skip_blank_pages:
+                    return page_result
+        
+        # Downscale for upload unless preprocessing already did
+        if upload_options and 'upload' not in (preprocessed or {}):
+            try:
+                image_data, page_result['upload'] = await asyncio.to_thread(
+                    fit_image_data, image_data, upload_options, image.get('dpi')
+                )
+            except ValueError as e:
+                page_result['upload_error'] = str(e)
+        elif preprocessed and 'upload' in preprocessed:
+            page_result['upload'] = preprocessed['upload']
+        
+        for name, response in (await run_analyses(stages, image_data, model, plan)).items():
+            if 'error' in response:
+                page_result[f'{name}_error'] = response['error']
+            else:
+                page_result[name] = response.get('result', {})
+    except Exception as e:
+        logging.error(f"Error processing page {image.get('page_number')}: {str(e)}")
+        page_result['error'] = str(e)
+    return page_result
+
+async def run_analyses(stages, data, model, plan):
+    """
+    Make the planned Document Intelligence calls for one page image or sub-PDF.
+
+    Returns {"layout": response, "content": response} for the requested
+    outputs. A layout derived from the content result falls back to a
+    prebuilt-layout call if the result has no pages after all.
+    """
+    calls = {}
+    if 'layout' in plan['calls']:
+        calls['layout'] = stages.analyze_layout_async(data)
+    if 'content' in plan['calls']:
+        calls['content'] = stages.analyze_content_async(data, model)
+    responses = dict(zip(calls, await asyncio.gather(*calls.values())))
+    
+    if plan['layout_from_content']:
+        content = responses['content']
+        layout = None if 'error' in content else layout_from_document(content.get('result', {}))
+        if layout is None:
+            responses['layout'] = {"error": content['error']}
+        elif layout['pages']:
+            responses['layout'] = {"result": layout}
+        else:
+            responses['layout'] = await stages.analyze_layout_async(data)
+    return {name: responses[name] for name in ('layout', 'content') if name in responses}
+
+async def analyze_pdf_chunks(stages, chunks, model, plan, max_concurrency):
+    """
+    Analyze the sub-PDFs of a document concurrently and merge them into one result.
+
+    Returns the merged layout and/or content (see merge_results) plus one
+    entry per sub-PDF with its pages, size and any layout/content error;
+    the pages of a failed sub-PDF are missing from the merged result.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    
+    async def analyze(chunk_bytes):
+        async with semaphore:
+            return await run_analyses(stages, base64.b64encode(chunk_bytes).decode(), model, plan)
+    
+    chunk_responses = await asyncio.gather(*(analyze(chunk_bytes) for _, chunk_bytes in chunks))
+    
+    document = {"chunks": []}
+    merged = {'layout': [], 'content': []}
+    for (page_numbers, chunk_bytes), responses in zip(chunks, chunk_responses):
+        chunk_result = {"pages": page_numbers, "bytes": len(chunk_bytes)}
+        for name, response in responses.items():
+            if 'error' in response:
+                chunk_result[f'{name}_error'] = response['error']
+            else:
+                merged[name].append((page_numbers, response.get('result', {})))
+        document['chunks'].append(chunk_result)
+    
+    if 'layout' in plan['calls'] or plan['layout_from_content']:
+        document['layout'] = merge_results(merged['layout'], 'content')
+    if 'content' in plan['calls']:
+        document['content'] = merge_results(merged['content'], 'full_text')
+    return document
+
+async def iter_concurrent(function, items, limit):
+    """
+    Run the coroutine function(*item) for each item, yielding (item, result) in input order.
+
+    At most limit items are in flight, and a slot is refilled as soon as any
+    of them finishes, so one slow item does not hold the others back. Results
+    that finish ahead of it are kept until their turn, up to 2 * limit items
+    taken but not yielded. The next item is only taken from the iterable
+    when there is room, so streamed pages are pulled as needed; it is
+    advanced on a worker thread because pulling a page renders or
+    preprocesses it.
+    """
+    limit = max(1, limit)
+    remaining = iter(items)
+    running = {}
+    finished = {}
+    taken = 0
+    yielded = 0
+    exhausted = False
+    
+    async def submit():
+        nonlocal taken, exhausted
+        item = await asyncio.to_thread(next, remaining, None)
+        if item is None:
+            exhausted = True
+            return
+        running[asyncio.create_task(function(*item))] = (taken, item)
+        taken += 1
+    
+    try:
+        while True:
+            while not exhausted and len(running) < limit and taken - yielded < 2 * limit:
+                await submit()
+            while yielded in finished:
+                yield finished.pop(yielded)
+                yielded += 1
+            if not running:
+                break
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index, item = running.pop(task)
+                finished[index] = (item, task.result())
+    finally:
+        for task in running:
+            task.cancel()
+
+def get_limit(options, key, maximum):
+    """Read an optional positive integer option, capped at maximum (also its default)."""
+    value = options.get(key)
+    if value is None:
+        return maximum
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise ValueError(f"{key} must be a positive integer, got {value!r}")
+    return min(value, maximum)
+
+def check_page_selection(pdf_bytes, pages, max_pages):
+    """Raise ValueError if a page selection does not fit the PDF (see parse_page_selection)."""
+    pdf_document = open_pdf(pdf_bytes)
+    try:
+        parse_page_selection(pages, len(pdf_document), max_pages)
+    finally:
+        pdf_document.close()
+
 def get_base_url(req):
-    """Get the base URL for function calls."""
+    """Get the base URL for function calls in the http stage mode."""
     # For local development
     if req.headers.get('x-forwarded-host'):
         return f"https://{req.headers.get('x-forwarded-host')}"
     return "http://localhost:7071"
 
-def convert_pdf_to_images(base_url, pdf_bytes):
-    """Call the ConvertPdfToImages function."""
-    try:
-        response = requests.post(
-            f"{base_url}/api/convert_pdf_to_images",
-            data=pdf_bytes,
-            headers={"Content-Type": "application/pdf"},
-            timeout=30  # Increased from 10 to 30 seconds
-        )
-        return response.json()
-    except Exception as e:
-        return {"error": f"Error converting PDF: {str(e)}"}
+def stream_pdf_pages(pdf_bytes, conversion, conversion_options=None):
+    """Render PDF pages in-process, yielding one base64 page image at a time."""
+    for page_number, image_bytes, metadata in iter_pdf_pages(pdf_bytes, **(conversion_options or {})):
+        conversion['image_count'] = metadata['page_count']
+        yield {
+            "page_number": page_number,
+            "dpi": metadata['dpi'],
+            "image_data": base64.b64encode(image_bytes).decode()
+        }
 
-def preprocess_image(base_url, image_data, options):
-    """Call the PreprocessImage function."""
-    try:
-        response = requests.post(
-            f"{base_url}/api/preprocess_image",
-            json={"image_data": image_data, "options": options},
-            headers={"Content-Type": "application/json"},
-            timeout=30  # Increased from 10 to 30 seconds
-        )
-        return response.json()
-    except Exception as e:
-        return {"error": f"Error preprocessing image: {str(e)}"}
+def stream_preprocessed_pages(pdf_bytes, conversion, conversion_options, preprocessing_options):
+    """
+    Render and preprocess PDF pages in-process, yielding (image, preprocessed) pairs.
 
-def analyze_document_layout(base_url, image_data):
-    """Call the AnalyzeLayout function."""
+    Pages go from the renderer to the preprocessing pipeline as arrays, so
+    each page is encoded and base64-encoded once, after preprocessing.
+    """
     try:
-        response = requests.post(
-            f"{base_url}/api/analyze_layout",
-            json={"image_data": image_data},
-            headers={"Content-Type": "application/json"},
-            timeout=45  # Increased from 10 to 45 seconds
+        pipeline = compile_pipeline(preprocessing_options)
+    except ValueError as e:
+        # Invalid options fail preprocessing of every page, as in the endpoint
+        for image in stream_pdf_pages(pdf_bytes, conversion, conversion_options):
+            yield image, {"error": str(e)}
+        return
+    for page_number, image_bytes, metadata in iter_preprocessed_pages(
+        pdf_bytes, pipeline, **(conversion_options or {})
+    ):
+        conversion['image_count'] = metadata['page_count']
+        image_data = base64.b64encode(image_bytes).decode()
+        yield (
+            {"page_number": page_number, "dpi": metadata['dpi'], "image_data": image_data},
+            {"processed_image": image_data, **metadata}
         )
-        return response.json()
-    except Exception as e:
-        return {"error": f"Error analyzing layout: {str(e)}"}
 
-def analyze_document_content(base_url, image_data, model):
-    """Call the AnalyzeDocument function."""
-    try:
-        response = requests.post(
-            f"{base_url}/api/analyze_document",
-            json={"image_data": image_data, "model": model},
-            headers={"Content-Type": "application/json"},
-            timeout=60  # Increased from 10 to 60 seconds
-        )
-        return response.json()
-    except Exception as e:
-        return {"error": f"Error analyzing content: {str(e)}"}
\ No newline at end of file
+def preprocess_pages(stages, images, options, batch_size):
+    """
+    Preprocess page images through the batch form of the preprocessing stage.
+
+    Pages are sent batch_size at a time so streamed renders keep flowing,
+    and (image, preprocessed) pairs are yielded in page order.
+    """
+    for batch in iter_batches(images, batch_size):
+        response = stages.preprocess_batch([image['image_data'] for image in batch], options)
+        results = response.get('results', [])
+        for index, image in enumerate(batch):
+            if 'error' in response:
+                yield image, response
+            elif index < len(results):
+                yield image, results[index]
+            else:
+                yield image, {"error": "No preprocessing result returned"}
+
+def iter_batches(items, batch_size):
+    """Group an iterable into lists of at most batch_size items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= max(1, batch_size):
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,399 @@
+import os
+import asyncio
+import logging
+import weakref
+from azure.ai.formrecognizer import DocumentAnalysisClient
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient as AsyncDocumentAnalysisClient
+from azure.core.credentials import AzureKeyCredential
+from shared_code.utils import DOCUMENT_INTELLIGENCE_ENDPOINT, DOCUMENT_INTELLIGENCE_KEY
+
+# Model used for the analyze_layout view
+LAYOUT_MODEL = "prebuilt-layout"
+DEFAULT_MODEL = "prebuilt-document"
+# Models documented to return the full layout output of prebuilt-layout
+# (pages, lines, tables and selection marks), plus any listed in
+# DI_MODELS_WITH_LAYOUT (comma separated, e.g. custom models)
+MODELS_WITH_LAYOUT = {LAYOUT_MODEL, "prebuilt-document", "prebuilt-invoice"} | {
+    model.strip() for model in os.getenv("DI_MODELS_WITH_LAYOUT", "").split(",") if model.strip()
+}
+
+_client = None
+# aio clients hold a session bound to the event loop they are used on
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_document_client():
+    """Return the process-wide Document Intelligence client configured from the environment."""
+    global _client
+    if _client is None:
+        # The client is thread-safe and reuses its HTTP connections
+        _client = DocumentAnalysisClient(
+            DOCUMENT_INTELLIGENCE_ENDPOINT,
+            AzureKeyCredential(DOCUMENT_INTELLIGENCE_KEY),
+        )
+    return _client
+
+
+def analyze_bytes(image_bytes, model=DEFAULT_MODEL):
+    """Send one image (or PDF) to Document Intelligence and wait for the result."""
+    poller = get_document_client().begin_analyze_document(model, image_bytes)
+    return poller.result()
+
+
+def get_async_document_client():
+    """Return the async Document Intelligence client of the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncDocumentAnalysisClient(
+            DOCUMENT_INTELLIGENCE_ENDPOINT,
+            AzureKeyCredential(DOCUMENT_INTELLIGENCE_KEY),
+        )
+    return client
+
+
+async def analyze_bytes_async(image_bytes, model=DEFAULT_MODEL):
+    """
+    Async analyze_bytes: the long-running operation is polled on the event
+    loop, so many analyses can wait at once without holding a thread each.
+    """
+    poller = await get_async_document_client().begin_analyze_document(model, image_bytes)
+    return await poller.result()
+
+
+def analyze_layout(image_bytes):
+    """Analyze the layout of an image with prebuilt-layout; returns layout_result."""
+    return layout_result(analyze_bytes(image_bytes, LAYOUT_MODEL))
+
+
+def analyze_document(image_bytes, model=DEFAULT_MODEL):
+    """Analyze the content of an image with the given model; returns document_result."""
+    return document_result(analyze_bytes(image_bytes, model))
+
+
+async def analyze_layout_async(image_bytes):
+    """Async analyze_layout."""
+    return layout_result(await analyze_bytes_async(image_bytes, LAYOUT_MODEL))
+
+
+async def analyze_document_async(image_bytes, model=DEFAULT_MODEL):
+    """Async analyze_document."""
+    return document_result(await analyze_bytes_async(image_bytes, model))
+
+
+def model_has_layout(model):
+    """
+    Whether a model's result carries the layout data, so layout_from_document
+    can be used. Unknown models are assumed not to, since a missing table
+    would go unnoticed.
+    """
+    return model in MODELS_WITH_LAYOUT
+
+
+def plan_analyses(analyze_layout, analyze_content, model, derive_layout=True):
+    """
+    Plan the fewest Document Intelligence calls that give the requested outputs.
+
+    When both layout and content are wanted and the content model returns
+    layout data, the layout view is derived from the content result and
+    prebuilt-layout is not called.
+
+    Returns:
+        dict: calls, the outputs to request ("layout" and/or "content"),
+            and layout_from_content
+    """
+    layout_from_content = bool(
+        derive_layout and analyze_layout and analyze_content and model_has_layout(model)
+    )
+    calls = []
+    if analyze_layout and not layout_from_content:
+        calls.append("layout")
+    if analyze_content:
+        calls.append("content")
+    return {"calls": calls, "layout_from_content": layout_from_content}
+
+
+def _spans(item):
+    return [
+        {"offset": span.offset, "length": span.length}
+        for span in (getattr(item, "spans", None) or [])
+    ]
+
+
+def _bounding_regions(item):
+    return [
+        {"page_number": region.page_number, "polygon": region.polygon}
+        for region in (getattr(item, "bounding_regions", None) or [])
+    ]
+
+
+def layout_result(result):
+    """
+    Format an analysis result as pages with lines and tables with cells.
+    The line and cell spans point into content, the text of the document.
+    """
+    layout = {"content": result.content or "", "pages": [], "tables": []}
+
+    for page in result.pages or []:
+        layout["pages"].append({
+            "page_number": page.page_number,
+            "width": page.width,
+            "height": page.height,
+            "unit": page.unit,
+            "lines": [
+                {"text": line.content, "bounding_regions": _spans(line)}
+                for line in (page.lines or [])
+            ],
+        })
+
+    for table in result.tables or []:
+        layout["tables"].append({
+            "row_count": table.row_count,
+            "column_count": table.column_count,
+            "cells": [
+                {
+                    "row_index": cell.row_index,
+                    "column_index": cell.column_index,
+                    "text": cell.content,
+                    "bounding_regions": _spans(cell),
+                }
+                for cell in table.cells
+            ],
+        })
+
+    return layout
+
+
+def layout_from_document(document):
+    """Build the layout_result view from a document_result, without another analysis."""
+    return {
+        "content": document.get("full_text", ""),
+        "pages": [
+            {
+                "page_number": page["page_number"],
+                "width": page["width"],
+                "height": page["height"],
+                "unit": page["unit"],
+                "lines": [
+                    {"text": line["content"], "bounding_regions": line.get("spans", [])}
+                    for line in page.get("lines", [])
+                ],
+            }
+            for page in document.get("pages", [])
+        ],
+        "tables": [
+            {
+                "row_count": table["row_count"],
+                "column_count": table["column_count"],
+                "cells": [
+                    {
+                        "row_index": cell["row_index"],
+                        "column_index": cell["column_index"],
+                        "text": cell["content"],
+                        "bounding_regions": cell.get("spans", []),
+                    }
+                    for cell in table.get("cells", [])
+                ],
+            }
+            for table in document.get("tables", [])
+        ],
+    }
+
+
+def document_result(result):
+    """
+    Format an analysis result with everything the model returned: text,
+    languages, styles, paragraphs, pages (lines, words, selection marks),
+    tables, key-value pairs and documents with their fields.
+    """
+    document = {
+        "full_text": result.content if result.content else "",
+        "languages": [],
+        "styles": [],
+        "paragraphs": [],
+        "pages": [],
+        "tables": [],
+        "key_value_pairs": [],
+        "documents": [],
+    }
+
+    # Detected languages
+    for language in getattr(result, "languages", None) or []:
+        document["languages"].append({
+            "locale": language.locale,
+            "confidence": language.confidence,
+            "spans": _spans(language),
+        })
+
+    # Text styles (handwritten, bold, etc.)
+    for style in getattr(result, "styles", None) or []:
+        document["styles"].append({
+            "is_handwritten": getattr(style, "is_handwritten", False),
+            "confidence": getattr(style, "confidence", 0.0),
+            "spans": _spans(style),
+        })
+
+    # Paragraphs with their role (title, sectionHeading, etc.)
+    for para_idx, paragraph in enumerate(getattr(result, "paragraphs", None) or []):
+        para_info = {
+            "paragraph_index": para_idx,
+            "content": paragraph.content,
+            "role": getattr(paragraph, "role", None),
+            "bounding_regions": _bounding_regions(paragraph),
+        }
+        if getattr(paragraph, "spans", None):
+            para_info["spans"] = _spans(paragraph)
+        document["paragraphs"].append(para_info)
+
+    # Page-level information (lines, words, selection marks)
+    for page_idx, page in enumerate(result.pages or []):
+        page_data = {
+            "page_number": page_idx + 1,
+            "width": page.width,
+            "height": page.height,
+            "unit": page.unit,
+            "angle": getattr(page, "angle", 0.0),
+            "lines": [],
+            "words": [],
+            "selection_marks": [],
+        }
+
+        for line_idx, line in enumerate(getattr(page, "lines", None) or []):
+            line_data = {"line_index": line_idx, "content": line.content, "polygon": line.polygon}
+            if getattr(line, "spans", None):
+                line_data["spans"] = _spans(line)
+            page_data["lines"].append(line_data)
+
+        for word_idx, word in enumerate(getattr(page, "words", None) or []):
+            word_data = {
+                "word_index": word_idx,
+                "content": word.content,
+                "confidence": word.confidence,
+                "polygon": word.polygon,
+            }
+            if getattr(word, "span", None):
+                word_data["spans"] = [{"offset": word.span.offset, "length": word.span.length}]
+            page_data["words"].append(word_data)
+
+        # Checkboxes and radio buttons: "selected" or "unselected"
+        for mark_idx, mark in enumerate(getattr(page, "selection_marks", None) or []):
+            mark_data = {
+                "mark_index": mark_idx,
+                "state": mark.state,
+                "confidence": mark.confidence,
+                "polygon": mark.polygon,
+            }
+            if getattr(mark, "span", None):
+                mark_data["spans"] = [{"offset": mark.span.offset, "length": mark.span.length}]
+            page_data["selection_marks"].append(mark_data)
+
+        document["pages"].append(page_data)
+
+    for table_idx, table in enumerate(getattr(result, "tables", None) or []):
+        table_data = {
+            "table_index": table_idx,
+            "row_count": table.row_count,
+            "column_count": table.column_count,
+            "cells": [],
+            "bounding_regions": _bounding_regions(table),
+        }
+        for cell in table.cells:
+            cell_data = {
+                "content": cell.content,
+                "row_index": cell.row_index,
+                "column_index": cell.column_index,
+                "row_span": getattr(cell, "row_span", 1),
+                "column_span": getattr(cell, "column_span", 1),
+                "kind": getattr(cell, "kind", None),  # "content", "rowHeader", "columnHeader"
+                "confidence": getattr(cell, "confidence", 0.0),
+                "polygon": cell.bounding_regions[0].polygon if getattr(cell, "bounding_regions", None) else [],
+            }
+            if getattr(cell, "spans", None):
+                cell_data["spans"] = _spans(cell)
+            table_data["cells"].append(cell_data)
+        document["tables"].append(table_data)
+
+    for kv_pair in getattr(result, "key_value_pairs", None) or []:
+        document["key_value_pairs"].append({
+            "key": kv_pair.key.content if kv_pair.key else None,
+            "value": kv_pair.value.content if kv_pair.value else None,
+            "confidence": kv_pair.confidence,
+        })
+
+    # Document-level fields (for prebuilt models such as invoices)
+    for doc_idx, analyzed in enumerate(getattr(result, "documents", None) or []):
+        document["documents"].append({
+            "document_index": doc_idx,
+            "doc_type": analyzed.doc_type,
+            "confidence": analyzed.confidence,
+            "fields": {
+                field_name: {
+                    "content": getattr(field, "content", None),
+                    "confidence": getattr(field, "confidence", 0.0),
+                    "value_type": str(getattr(field, "value_type", "unknown")),
+                }
+                for field_name, field in (analyzed.fields or {}).items()
+            },
+        })
+
+    logging.info(
+        f"Analyzed {len(document['pages'])} pages, {len(document['paragraphs'])} paragraphs, "
+        f"{len(document['tables'])} tables"
+    )
+    return document
+
+
+# Lists whose *_index numbers run across the whole document
+DOCUMENT_INDEX_KEYS = {"paragraphs": "paragraph_index", "tables": "table_index", "documents": "document_index"}
+# Separator Document Intelligence puts between the text of two pages
+PAGE_SEPARATOR = "\n"
+
+
+def _rebase(value, offset, page_numbers):
+    """Shift the spans in a formatted chunk result by offset and map its page numbers."""
+    if isinstance(value, dict):
+        if value.keys() == {"offset", "length"}:
+            return {"offset": value["offset"] + offset, "length": value["length"]}
+        return {
+            key: page_numbers[item - 1] if key == "page_number" else _rebase(item, offset, page_numbers)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [_rebase(item, offset, page_numbers) for item in value]
+    return value
+
+
+def merge_results(chunks, text_key):
+    """
+    Merge the formatted results of the sub-PDFs of one document into one result.
+
+    Args:
+        chunks: (page_numbers, result) per sub-PDF in page order, where
+            page_numbers maps the sub-PDF's pages to the original ones
+        text_key: Key of the document text in result ("content" for
+            layout_result, "full_text" for document_result)
+
+    Returns:
+        dict: The result as if the pages had been analyzed in one request:
+            texts joined, page numbers renumbered, span offsets rebased onto
+            the joined text and document-wide indexes renumbered
+    """
+    merged = {text_key: ""}
+    texts = []
+    offset = 0
+    for page_numbers, result in chunks:
+        text = result.get(text_key) or ""
+        rebased = _rebase(result, offset, page_numbers)
+        for key, value in rebased.items():
+            if isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+        texts.append(text)
+        offset += len(text) + len(PAGE_SEPARATOR)
+
+    for key, index_key in DOCUMENT_INDEX_KEYS.items():
+        for index, item in enumerate(merged.get(key, [])):
+            if index_key in item:
+                item[index_key] = index
+    merged[text_key] = PAGE_SEPARATOR.join(texts)
+    return merged
+
@@ -0,0 +1,952 @@
+import os
+import base64
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import math
+import cv2
+import fitz
+import numpy as np
+from PIL import Image
+from shared_code.utils import (
+    COLORSPACES, BILEVEL_THRESHOLD, IMAGE_FORMATS, open_pdf, parse_page_selection,
+    page_render_dpi, validate_colorspace, validate_image_format, encode_pil_image,
+    extract_page_image,
+)
+
+# Threads used to preprocess a batch of images; OpenCV releases the GIL
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", str(os.cpu_count() or 1)))
+# Images larger than this are processed in horizontal strips (see Pipeline)
+PREPROCESS_TILE_MB = float(os.getenv("PREPROCESS_TILE_MB", "128"))
+
+# Auto mode: quality statistics are computed on a copy no longer than this
+AUTO_ANALYSIS_MAX_EDGE = 1024
+# A page is blank when fewer pixels than this ratio are ink and its contrast
+# is below AUTO_BLANK_CONTRAST. A "Page 3 of 12" footer is about 0.0003
+AUTO_BLANK_INK_RATIO = float(os.getenv("AUTO_BLANK_INK_RATIO", "0.0001"))
+AUTO_BLANK_CONTRAST = 0.05
+# Pixels this much darker or lighter than the page background count as ink
+AUTO_INK_DELTA = 48
+# Share of pixels ignored at each end of the intensity range when measuring
+# contrast; lowered to half the ink ratio on sparse pages so the percentiles
+# still land on ink
+AUTO_CONTRAST_PERCENTILE = 0.001
+# Noise is measured on background pixels: those whose 3x3 neighbourhood
+# varies less than this after a 3x3 median, which keeps text edges out
+AUTO_FLAT_GRADIENT = 16
+# Mean absolute difference from a 3x3 median on background pixels above
+# which a page is denoised. Clean renders of sample-data score 0.02-0.23 and
+# the same pages with sigma-4 gaussian or 0.3% pepper noise 0.55 or more
+AUTO_NOISE_LEVEL = 0.4
+# Percentile contrast (0-1) below which a page is adaptively thresholded
+AUTO_MIN_CONTRAST = 0.5
+# Laplacian variance below which a page is reported as blurry
+AUTO_BLUR_VARIANCE = 100.0
+# Skew (degrees) from which a page is deskewed
+AUTO_MIN_SKEW = 0.5
+
+# Output encoding: settings accepted in an "output" options dict
+OUTPUT_OPTIONS = ("format", "compression_level", "quality", "bit_depth")
+# Auto output picks JPEG for color images with more distinct colors than
+# this on a small thumbnail (photos); drawings and scans stay lossless
+AUTO_PHOTO_COLORS = 4096
+
+# Leading bytes of the encoded formats auto mode can pass through untouched:
+# (signature, offset, format, mimetype)
+PASSTHROUGH_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", 0, "png", "image/png"),
+    (b"\xff\xd8\xff", 0, "jpeg", "image/jpeg"),
+    (b"WEBP", 8, "webp", "image/webp"),
+    (b"II*\x00", 0, "tiff", "image/tiff"),
+    (b"MM\x00*", 0, "tiff", "image/tiff"),
+)
+
+# Upload fitting: settings accepted in an "upload" options dict
+UPLOAD_OPTIONS = ("max_edge", "target_dpi", "source_dpi", "max_bytes", "quality")
+# DPI pages are assumed to be rendered at when target_dpi is used without source_dpi
+UPLOAD_SOURCE_DPI = 300
+
+
+def decode_image(image_bytes, input_colorspace="auto"):
+    """
+    Decodes encoded image bytes with OpenCV.
+
+    Args:
+        image_bytes: Encoded image (PNG, JPEG, TIFF, ...)
+        input_colorspace: Colorspace the image was rendered in. "gray" and
+            "bilevel" decode straight to one channel, "rgb" to BGR, and
+            "auto" keeps grayscale images single-channel.
+
+    Returns:
+        numpy.ndarray: The decoded image
+
+    Raises:
+        ValueError: If the bytes cannot be decoded as an image
+    """
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    if input_colorspace in ('gray', 'bilevel'):
+        image = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
+    elif input_colorspace == 'rgb':
+        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    else:
+        image = cv2.imdecode(nparr, cv2.IMREAD_ANYCOLOR)
+    if image is None:
+        raise ValueError("Could not decode image data")
+    return image
+
+
+def _to_gray(image):
+    if image.ndim == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+
+def _odd_kernel(name, ksize):
+    if ksize < 1 or ksize % 2 == 0:
+        raise ValueError(f"{name} ksize must be a positive odd number, got {ksize}")
+
+
+def op_grayscale(image):
+    return _to_gray(image)
+
+
+def op_gaussian_blur(image, ksize=5, sigma=0.0):
+    # The destination is the (already owned) input, so no new image is allocated
+    return cv2.GaussianBlur(image, (ksize, ksize), sigma, dst=image)
+
+
+def op_median(image, ksize=3):
+    return cv2.medianBlur(image, ksize)
+
+
+def op_threshold(image, thresh=150, maxval=255, otsu=False):
+    image = _to_gray(image)
+    flags = cv2.THRESH_BINARY | (cv2.THRESH_OTSU if otsu else 0)
+    cv2.threshold(image, thresh, maxval, flags, dst=image)
+    return image
+
+
+def op_adaptive_threshold(image, block_size=31, c=10, method="gaussian", maxval=255):
+    adaptive_method = (
+        cv2.ADAPTIVE_THRESH_GAUSSIAN_C if method == "gaussian" else cv2.ADAPTIVE_THRESH_MEAN_C
+    )
+    return cv2.adaptiveThreshold(
+        _to_gray(image), maxval, adaptive_method, cv2.THRESH_BINARY, block_size, c
+    )
+
+
+def op_canny(image, low=50, high=150):
+    return cv2.Canny(_to_gray(image), low, high)
+
+
+def op_morphology(image, operation="close", ksize=3, iterations=1, shape="rect"):
+    kernel = cv2.getStructuringElement(MORPH_SHAPES[shape], (ksize, ksize))
+    return cv2.morphologyEx(
+        image, MORPH_OPERATIONS[operation], kernel, dst=image, iterations=iterations
+    )
+
+
+def estimate_skew(gray):
+    """
+    Estimates the skew angle of the text on a grayscale page, in degrees.
+
+    Dark pixels are treated as ink and the angle of their minimum-area
+    bounding rectangle is normalized to [-45, 45).
+    """
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    points = cv2.findNonZero(ink)
+    if points is None:
+        return 0.0
+    angle = cv2.minAreaRect(points)[-1]
+    # OpenCV reports the angle in (0, 90] or [-90, 0) depending on the version
+    if angle >= 45:
+        angle -= 90
+    elif angle < -45:
+        angle += 90
+    return float(angle)
+
+
+def op_deskew(image, max_angle=10.0, min_angle=0.1):
+    angle = estimate_skew(_to_gray(image))
+    if abs(angle) < min_angle or abs(angle) > max_angle:
+        return image
+    height, width = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    return cv2.warpAffine(
+        image, matrix, (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE
+    )
+
+
+def op_resize(image, scale=None, max_edge=None, width=None, height=None, interpolation="auto"):
+    source_height, source_width = image.shape[:2]
+    if scale is None and max_edge is not None:
+        scale = min(1.0, max_edge / max(source_height, source_width))
+    if scale is not None:
+        size = (max(1, round(source_width * scale)), max(1, round(source_height * scale)))
+    else:
+        size = (
+            width or max(1, round(source_width * height / source_height)),
+            height or max(1, round(source_height * width / source_width)),
+        )
+    if size == (source_width, source_height):
+        return image
+    if interpolation == "auto":
+        # Area averaging for downscaling, cubic for upscaling
+        shrinking = size[0] * size[1] < source_width * source_height
+        interpolation = "area" if shrinking else "cubic"
+    return cv2.resize(image, size, interpolation=INTERPOLATIONS[interpolation])
+
+
+def analyze_image_quality(image):
+    """
+    Computes cheap quality statistics of a page on a downsampled grayscale copy.
+
+    The ink ratio is counted on the full-resolution image, in both
+    polarities, because shrinking averages thin strokes into the background.
+
+    Returns:
+        dict: laplacian_variance (low means blurry), contrast (spread
+            between the darkest and lightest intensities, 0-1), noise
+            (mean difference from a 3x3 median on background pixels), skew (degrees), ink_ratio
+            and blank_score (1 for an empty page), plus blurry and blank flags
+    """
+    gray = _to_gray(image)
+    # The median intensity is the page background; ink is clearly darker, or
+    # lighter on inverted pages
+    full_histogram = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+    full_cumulative = np.cumsum(full_histogram) / full_histogram.sum()
+    background = int(np.searchsorted(full_cumulative, 0.5))
+    dark = full_cumulative[background - AUTO_INK_DELTA - 1] if background > AUTO_INK_DELTA else 0.0
+    light = (
+        1.0 - full_cumulative[background + AUTO_INK_DELTA]
+        if background + AUTO_INK_DELTA < 255 else 0.0
+    )
+    ink_ratio = float(dark + light)
+
+    height, width = gray.shape[:2]
+    scale = AUTO_ANALYSIS_MAX_EDGE / max(height, width)
+    if scale < 1:
+        gray = cv2.resize(
+            gray, (max(1, round(width * scale)), max(1, round(height * scale))),
+            interpolation=cv2.INTER_AREA
+        )
+
+    histogram = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+    cumulative = np.cumsum(histogram) / histogram.sum()
+    percentile = min(AUTO_CONTRAST_PERCENTILE, ink_ratio / 2) or AUTO_CONTRAST_PERCENTILE
+    low = int(np.searchsorted(cumulative, percentile))
+    high = int(np.searchsorted(cumulative, 1 - percentile))
+    contrast = (high - low) / 255
+
+    laplacian_variance = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    # Speckles vanish in the median while text edges stay, so the flat
+    # pixels of the median are background including its noise
+    median = cv2.medianBlur(gray, 3)
+    gradient = cv2.morphologyEx(median, cv2.MORPH_GRADIENT, np.ones((3, 3), np.uint8))
+    flat = gradient < AUTO_FLAT_GRADIENT
+    noise = float(cv2.absdiff(gray, median)[flat].mean()) if flat.any() else 0.0
+    blank_score = max(0.0, 1.0 - ink_ratio / AUTO_BLANK_INK_RATIO)
+    # Low-contrast text can stay within AUTO_INK_DELTA of the background, but
+    # it still spreads the intensities; an empty page does not
+    blank = blank_score > 0 and contrast < AUTO_BLANK_CONTRAST
+    return {
+        "laplacian_variance": round(laplacian_variance, 2),
+        "contrast": round(contrast, 3),
+        "noise": round(noise, 3),
+        "skew": 0.0 if blank else round(estimate_skew(gray), 2),
+        "ink_ratio": round(ink_ratio, 5),
+        "blank_score": round(blank_score, 3),
+        "blurry": laplacian_variance < AUTO_BLUR_VARIANCE,
+        "blank": blank,
+    }
+
+
+def auto_pipeline_spec(quality):
+    """Choose the minimal pipeline spec for a page from its analyze_image_quality stats."""
+    spec = []
+    if quality["blank"]:
+        return spec
+    if AUTO_MIN_SKEW <= abs(quality["skew"]) <= 10:
+        spec.append({"op": "deskew"})
+    if quality["noise"] > AUTO_NOISE_LEVEL:
+        spec.append({"op": "median", "ksize": 3})
+    if quality["contrast"] < AUTO_MIN_CONTRAST:
+        spec.append({"op": "adaptive_threshold", "block_size": 31, "c": 10})
+    return spec
+
+
+MORPH_OPERATIONS = {
+    "erode": cv2.MORPH_ERODE,
+    "dilate": cv2.MORPH_DILATE,
+    "open": cv2.MORPH_OPEN,
+    "close": cv2.MORPH_CLOSE,
+}
+MORPH_SHAPES = {"rect": cv2.MORPH_RECT, "ellipse": cv2.MORPH_ELLIPSE, "cross": cv2.MORPH_CROSS}
+INTERPOLATIONS = {
+    "area": cv2.INTER_AREA,
+    "linear": cv2.INTER_LINEAR,
+    "cubic": cv2.INTER_CUBIC,
+    "nearest": cv2.INTER_NEAREST,
+}
+
+
+def _morphology_halo(params):
+    passes = 2 if params.get("operation", "close") in ("open", "close") else 1
+    return params.get("ksize", 3) // 2 * params.get("iterations", 1) * passes
+
+
+# Pipeline operations: name -> (function, produces a single-channel image,
+# halo). The halo gives the rows of context a step needs around each output
+# row; None marks global steps (Otsu, Canny hysteresis, deskew, resize)
+# that must see the whole image and are never tiled.
+OPERATIONS = {
+    "grayscale": (op_grayscale, True, lambda params: 0),
+    "gaussian_blur": (op_gaussian_blur, False, lambda params: params.get("ksize", 5) // 2),
+    "median": (op_median, False, lambda params: params.get("ksize", 3) // 2),
+    "threshold": (op_threshold, True, lambda params: None if params.get("otsu") else 0),
+    "adaptive_threshold": (
+        op_adaptive_threshold, True, lambda params: params.get("block_size", 31) // 2
+    ),
+    "canny": (op_canny, True, lambda params: None),
+    "morphology": (op_morphology, False, _morphology_halo),
+    "deskew": (op_deskew, False, lambda params: None),
+    "resize": (op_resize, False, lambda params: None),
+}
+
+
+# Parameters OpenCV only accepts as integers; other numeric parameters may be floats
+INTEGER_PARAMS = {"ksize", "block_size", "iterations", "width", "height"}
+
+
+def _validate_param_types(name, params, defaults):
+    """Check each parameter has the type of its default, so bad JSON is a ValueError."""
+    for key, value in params.items():
+        default = defaults[key]
+        if isinstance(default, bool):
+            valid, expected = isinstance(value, bool), "a boolean"
+        elif isinstance(default, str):
+            valid, expected = isinstance(value, str), "a string"
+        elif key in INTEGER_PARAMS:
+            valid, expected = isinstance(value, int) and not isinstance(value, bool), "an integer"
+        else:
+            valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+            expected = "a number"
+        if not valid:
+            raise ValueError(f"{name} {key} must be {expected}, got {value!r}")
+
+
+def _validate_step(name, params):
+    """Check parameter values that OpenCV would otherwise reject mid-pipeline."""
+    if name in ("gaussian_blur", "median", "morphology"):
+        _odd_kernel(name, params.get("ksize", 5 if name == "gaussian_blur" else 3))
+    if name == "adaptive_threshold":
+        block_size = params.get("block_size", 31)
+        if block_size < 3 or block_size % 2 == 0:
+            raise ValueError(f"adaptive_threshold block_size must be an odd number >= 3, got {block_size}")
+        if params.get("method", "gaussian") not in ("gaussian", "mean"):
+            raise ValueError("adaptive_threshold method must be 'gaussian' or 'mean'")
+    if name == "morphology":
+        if params.get("operation", "close") not in MORPH_OPERATIONS:
+            raise ValueError(f"morphology operation must be one of {sorted(MORPH_OPERATIONS)}")
+        if params.get("shape", "rect") not in MORPH_SHAPES:
+            raise ValueError(f"morphology shape must be one of {sorted(MORPH_SHAPES)}")
+    if name == "resize":
+        if params.get("interpolation", "auto") not in ("auto", *INTERPOLATIONS):
+            raise ValueError(f"resize interpolation must be 'auto' or one of {sorted(INTERPOLATIONS)}")
+        sizes = [params.get(key) for key in ("scale", "max_edge", "width", "height")]
+        if all(size is None for size in sizes):
+            raise ValueError("resize needs scale, max_edge, width or height")
+        if any(size is not None and size <= 0 for size in sizes):
+            raise ValueError("resize scale, max_edge, width and height must be positive")
+
+
+def legacy_pipeline(options):
+    """Translate the apply_* boolean options into the equivalent pipeline spec."""
+    spec = []
+    if any(options.get(flag) for flag in (
+        'apply_grayscale', 'apply_blur', 'apply_threshold', 'apply_edge_detection'
+    )):
+        spec.append({"op": "grayscale"})
+    if options.get('apply_blur'):
+        spec.append({"op": "gaussian_blur", "ksize": 5})
+    if options.get('apply_threshold'):
+        spec.append({"op": "threshold", "thresh": 150})
+    if options.get('apply_edge_detection'):
+        spec.append({"op": "canny", "low": 50, "high": 150})
+    return spec
+
+
+class Pipeline:
+    """
+    A validated, ordered list of preprocessing steps.
+
+    Built once per request with compile_pipeline and then run on any number
+    of images. When the first step discards color, images are decoded
+    straight to grayscale and that conversion is skipped, unless gray_decode
+    is False. The codec's grayscale conversion can differ by 1 from
+    cv2.cvtColor on some pixels, which may flip pixels at a threshold, so
+    the legacy apply_* options keep the color decode to match their
+    earlier output exactly.
+
+    Images bigger than tile_bytes are processed in horizontal strips, each
+    padded with a halo of neighbouring rows as wide as the combined reach
+    of the local steps, so the result is identical to whole-image
+    processing while intermediates stay strip-sized. Global steps (see
+    OPERATIONS) split the pipeline and run on the whole image.
+    """
+
+    def __init__(self, steps, input_colorspace="auto", tile_bytes=None, auto=False, upload=None,
+                 output=None, gray_decode=True):
+        self.steps = steps
+        self.tile_bytes = tile_bytes
+        self.auto = auto
+        self.upload = upload
+        self.output = output
+        self.decode_grayscale = input_colorspace in ('gray', 'bilevel') or bool(
+            gray_decode and steps and OPERATIONS[steps[0][0]][1]
+        )
+        self.input_colorspace = "gray" if self.decode_grayscale else input_colorspace
+        if steps and steps[0][0] == "grayscale" and self.decode_grayscale:
+            self.steps = steps[1:]
+
+    def process(self, image):
+        """
+        Run the pipeline on a decoded image, returning it with a report.
+
+        The report holds the per-step timings. In auto mode the steps are
+        chosen per image from analyze_image_quality, and the report also
+        holds the quality metrics, the chosen pipeline and the blank flag;
+        blank pages are returned untouched.
+        """
+        if not self.auto:
+            image, timings = self.run(image)
+            return image, {"timings": timings}
+
+        started = time.perf_counter()
+        quality = analyze_image_quality(image)
+        spec = auto_pipeline_spec(quality)
+        timings = [{"op": "analyze", "ms": round((time.perf_counter() - started) * 1000, 3)}]
+        pipeline = Pipeline(
+            [_compile_step(step) for step in spec], tile_bytes=self.tile_bytes
+        )
+        image, step_timings = pipeline.run(image)
+        return image, {
+            "timings": timings + step_timings,
+            "quality": quality,
+            "pipeline": spec,
+            "blank": quality["blank"],
+        }
+
+    def encode(self, image, report, source_dpi=None):
+        """
+        Encode a processed image, adding the encode timing to the report.
+
+        The image is encoded per the output options (PNG by default, see
+        encode_output), or fitted with encode_for_upload when there are
+        upload options, in which case report["upload"] describes the
+        result. report["format"] and report["mimetype"] give the codec.
+        """
+        started = time.perf_counter()
+        if self.upload:
+            upload = dict(self.upload)
+            if source_dpi and not upload.get("source_dpi"):
+                upload["source_dpi"] = source_dpi
+            image_bytes, report["upload"] = encode_for_upload(image, **upload)
+            image_format = report["upload"]["format"]
+        else:
+            image_bytes, image_format = encode_output(image, **(self.output or {}))
+        report["format"] = image_format
+        report["mimetype"] = IMAGE_FORMATS[image_format]["mimetype"]
+        report["timings"].append({"op": "encode", "ms": round((time.perf_counter() - started) * 1000, 3)})
+        return image_bytes
+
+    def run(self, image):
+        """Run every step on a decoded image, returning it with per-step timings."""
+        timings = []
+        for segment, halo in self.segments():
+            if halo is not None and self.tile_bytes and image.nbytes > self.tile_bytes:
+                image = self._run_tiled(image, segment, halo, timings)
+                continue
+            for name, function, params, _ in segment:
+                started = time.perf_counter()
+                image = function(image, **params)
+                timings.append({"op": name, "ms": round((time.perf_counter() - started) * 1000, 3)})
+        return image, timings
+
+    def segments(self):
+        """Split the steps into runs of local steps and single global steps, with their halo."""
+        segments = []
+        for step in self.steps:
+            step_halo = step[3]
+            if step_halo is None:
+                segments.append(([step], None))
+            elif segments and segments[-1][1] is not None:
+                steps, halo = segments[-1]
+                segments[-1] = (steps + [step], halo + step_halo)
+            else:
+                segments.append(([step], step_halo))
+        return segments
+
+    def _run_tiled(self, image, segment, halo, timings):
+        height = image.shape[0]
+        row_bytes = image.nbytes // height
+        # A strip, its copy and one intermediate are alive at a time
+        strip_rows = max(1, self.tile_bytes // (3 * row_bytes) - 2 * halo)
+        elapsed = [0.0] * len(segment)
+        output = None
+        tiles = 0
+        for top in range(0, height, strip_rows):
+            bottom = min(top + strip_rows, height)
+            start, stop = max(0, top - halo), min(height, bottom + halo)
+            # Copied so in-place steps cannot touch rows other strips still read
+            strip = image[start:stop].copy()
+            for index, (name, function, params, _) in enumerate(segment):
+                started = time.perf_counter()
+                strip = function(strip, **params)
+                elapsed[index] += time.perf_counter() - started
+            if output is None:
+                output = np.empty((height,) + strip.shape[1:], strip.dtype)
+            output[top:bottom] = strip[top - start:bottom - start]
+            tiles += 1
+        for (name, _, _, _), seconds in zip(segment, elapsed):
+            timings.append({"op": name, "ms": round(seconds * 1000, 3), "tiles": tiles})
+        return output
+
+
+def _compile_step(step):
+    """Validate one pipeline step and return it as (name, function, params, halo)."""
+    if isinstance(step, str):
+        step = {"op": step}
+    if not isinstance(step, dict) or step.get("op") not in OPERATIONS:
+        raise ValueError(f"Unknown pipeline op {step!r}; supported ops are {sorted(OPERATIONS)}")
+    params = {key: value for key, value in step.items() if key != "op"}
+    function = OPERATIONS[step["op"]][0]
+    accepted = function.__code__.co_varnames[1:function.__code__.co_argcount]
+    unknown = set(params) - set(accepted)
+    if unknown:
+        raise ValueError(f"Unknown parameters for {step['op']}: {sorted(unknown)}")
+    _validate_param_types(step["op"], params, dict(zip(accepted, function.__defaults__ or ())))
+    _validate_step(step["op"], params)
+    return step["op"], function, params, OPERATIONS[step["op"]][2](params)
+
+
+def compile_pipeline(options):
+    """
+    Validates the preprocessing options and compiles them into a Pipeline.
+
+    options["pipeline"] is an ordered list of steps, each an op name or a
+    dict such as {"op": "median", "ksize": 3}. Without it the legacy apply_*
+    booleans are used. "pipeline": "auto" picks the steps per image from
+    its measured quality (see auto_pipeline_spec). options["tile_memory_mb"]
+    overrides the size above which images are processed in strips
+    (PREPROCESS_TILE_MB, 0 disables). options["output"] selects the output
+    codec (see encode_output) and options["upload"] makes the final encode
+    downscale and pick a compact codec (see encode_for_upload).
+
+    Raises:
+        ValueError: If an op or one of its parameters is invalid
+    """
+    spec = options.get('pipeline')
+    legacy = spec is None
+    if legacy:
+        spec = legacy_pipeline(options)
+    auto = spec == "auto"
+    if auto:
+        spec = []
+    if not isinstance(spec, list):
+        raise ValueError('pipeline must be a list of steps or "auto"')
+
+    steps = [_compile_step(step) for step in spec]
+
+    tile_mb = options.get('tile_memory_mb', PREPROCESS_TILE_MB)
+    if not isinstance(tile_mb, (int, float)) or tile_mb < 0:
+        raise ValueError("tile_memory_mb must be a non-negative number (0 disables tiling)")
+    upload = options.get('upload')
+    if upload is not None:
+        validate_upload_options(upload)
+    output = options.get('output')
+    if output is not None:
+        validate_output_options(output)
+        if upload is not None:
+            raise ValueError("output and upload options cannot be combined; upload picks its own codec")
+    return Pipeline(
+        steps, options.get('input_colorspace', 'auto'), int(tile_mb * 1024 * 1024), auto, upload,
+        output, gray_decode=not legacy
+    )
+
+
+def preprocess_image_bytes(image_bytes, pipeline):
+    """
+    Decodes an encoded image, runs a compiled pipeline on it and re-encodes it.
+
+    Args:
+        image_bytes: Encoded input image
+        pipeline: Pipeline from compile_pipeline
+
+    Returns:
+        tuple: (image bytes, report) where report["timings"] lists the
+            decode, each step and the encode with their duration in
+            milliseconds (see Pipeline.process for the auto mode entries).
+            The image is encoded per Pipeline.encode, except in auto mode
+            when no step, output codec or upload fitting was asked for: then
+            the input bytes are returned as they are, with the format and
+            mimetype sniffed from them (unrecognised formats are encoded).
+    """
+    started = time.perf_counter()
+    image = decode_image(image_bytes, pipeline.input_colorspace)
+    decode_ms = round((time.perf_counter() - started) * 1000, 3)
+
+    image, report = pipeline.process(image)
+    report["timings"].insert(0, {"op": "decode", "ms": decode_ms})
+    if pipeline.auto and not report["pipeline"] and not (pipeline.upload or pipeline.output):
+        sniffed = sniff_image_format(image_bytes)
+        if sniffed is not None:
+            report["format"], report["mimetype"] = sniffed
+            return image_bytes, report
+    return pipeline.encode(image, report), report
+
+
+def sniff_image_format(image_bytes):
+    """Return (format, mimetype) of encoded image bytes from their signature, or None."""
+    for signature, offset, image_format, mimetype in PASSTHROUGH_SIGNATURES:
+        if image_bytes[offset:offset + len(signature)] == signature:
+            return image_format, mimetype
+    return None
+
+
+def preprocess_image_data(image_data, pipeline):
+    """Preprocess a base64 image, returning the base64 processed_image and the report."""
+    processed, report = preprocess_image_bytes(base64.b64decode(image_data), pipeline)
+    return {"processed_image": base64.b64encode(processed).decode('utf-8'), **report}
+
+
+def validate_upload_options(upload):
+    """Raise ValueError if an upload options dict (see encode_for_upload) is invalid."""
+    if not isinstance(upload, dict):
+        raise ValueError("upload options must be an object")
+    unknown = set(upload) - set(UPLOAD_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown upload options: {sorted(unknown)}")
+    for key, value in upload.items():
+        if value is not None and (not isinstance(value, (int, float)) or value <= 0):
+            raise ValueError(f"upload {key} must be a positive number")
+    if upload.get("quality") is not None and upload["quality"] > 100:
+        raise ValueError("upload quality must be between 1 and 100")
+
+
+def _is_two_tone(image):
+    return image.ndim == 2 and not np.any((image != 0) & (image != 255))
+
+
+def _to_pil(image):
+    if image.ndim == 3:
+        return Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    return Image.fromarray(image)
+
+
+def _looks_photographic(image):
+    if image.ndim != 3:
+        return False
+    height, width = image.shape[:2]
+    scale = min(1.0, 256 / max(height, width))
+    thumbnail = cv2.resize(
+        image, (max(1, round(width * scale)), max(1, round(height * scale))),
+        interpolation=cv2.INTER_AREA
+    )
+    colors = np.unique(thumbnail.reshape(-1, 3).view(np.dtype((np.void, 3))))
+    return len(colors) > AUTO_PHOTO_COLORS
+
+
+def validate_output_options(output):
+    """Raise ValueError if an output options dict (see encode_output) is invalid."""
+    if not isinstance(output, dict):
+        raise ValueError("output options must be an object")
+    unknown = set(output) - set(OUTPUT_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown output options: {sorted(unknown)}")
+    image_format = output.get("format", "png")
+    if image_format != "auto":
+        validate_image_format(image_format, output.get("compression_level"), output.get("quality"))
+    else:
+        validate_image_format("png", output.get("compression_level"), output.get("quality"))
+    if output.get("bit_depth") not in (None, 1, 8):
+        raise ValueError("output bit_depth must be 1 or 8")
+    if output.get("bit_depth") == 1 and image_format not in ("png", "auto"):
+        raise ValueError("output bit_depth only applies to png")
+
+
+def encode_output(image, format="png", compression_level=None, quality=None, bit_depth=None):
+    """
+    Encodes a processed image in the requested output format.
+
+    "auto" picks by image type: the smaller of CCITT G4 TIFF and 1-bit PNG
+    for two-tone images (thresholded or edge maps), JPEG for photographic
+    color images and PNG otherwise. bit_depth=1 writes a 1-bit PNG.
+
+    Returns:
+        tuple: (image_bytes, image_format)
+    """
+    if format == "auto":
+        if _is_two_tone(image):
+            return _encode_two_tone(image, compression_level)
+        elif _looks_photographic(image):
+            format = "jpeg"
+        else:
+            format = "png"
+    if format == "png" and bit_depth == 1:
+        pil_image = _to_pil(_to_gray(image)).convert("1", dither=0)
+        return encode_pil_image(pil_image, "png", compression_level), "png"
+    if format == "png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, compression_level] if compression_level is not None else []
+        _, buffer = cv2.imencode('.png', image, params)
+        return buffer.tobytes(), "png"
+    return encode_pil_image(_to_pil(image), format, compression_level, quality), format
+
+
+def _encode_two_tone(image, compression_level=None):
+    """Encode a two-tone image as the smaller of G4 TIFF and 1-bit PNG, returning (bytes, format)."""
+    pil_image = _to_pil(image).convert("1", dither=0)
+    candidates = [
+        (encode_pil_image(pil_image, "tiff-g4"), "tiff-g4"),
+        (encode_pil_image(pil_image, "png", compression_level), "png"),
+    ]
+    return min(candidates, key=lambda candidate: len(candidate[0]))
+
+
+def _compact_encode(image, quality, two_tone):
+    """Encode with the smallest codec Document Intelligence accepts, returning (bytes, format)."""
+    if two_tone:
+        # Two-tone pages (thresholded scans) are stored at 1 bit per pixel
+        return _encode_two_tone(image)
+    pil_image = _to_pil(image)
+    # WebP is smaller still but Document Intelligence does not accept it
+    candidates = [
+        (encode_pil_image(pil_image, image_format, quality=quality), image_format)
+        for image_format in ("png", "jpeg")
+    ]
+    return min(candidates, key=lambda candidate: len(candidate[0]))
+
+
+def encode_for_upload(image, max_edge=None, target_dpi=None, source_dpi=None, max_bytes=None,
+                      quality=None):
+    """
+    Downscales a decoded image and encodes it compactly for Document Intelligence.
+
+    The image is shrunk (never enlarged) with area interpolation so its
+    longest edge is at most max_edge and its resolution at most target_dpi,
+    then encoded at 1 bit per pixel (G4 TIFF or PNG, whichever is smaller)
+    if it is two-tone (re-thresholded after shrinking), otherwise as the
+    smaller of PNG and JPEG. If the result is still over max_bytes the image is shrunk
+    further until it fits; if it still does not fit after a few rounds the
+    last encoding is returned with info["over_budget"] set and a warning logged.
+
+    Args:
+        image: Decoded image (grayscale or BGR)
+        max_edge: Longest edge in pixels
+        target_dpi: Resolution to downscale to
+        source_dpi: Resolution the image has (default UPLOAD_SOURCE_DPI)
+        max_bytes: Ceiling on the encoded size
+        quality: JPEG quality 1-100 (default 85)
+
+    Returns:
+        tuple: (image_bytes, info) where info has format, mimetype, width,
+            height, the scale that was applied, the encoded bytes and
+            over_budget, whether that is still more than max_bytes
+    """
+    height, width = image.shape[:2]
+    scale = 1.0
+    if max_edge:
+        scale = min(scale, max_edge / max(height, width))
+    if target_dpi:
+        scale = min(scale, target_dpi / (source_dpi or UPLOAD_SOURCE_DPI))
+
+    two_tone = _is_two_tone(image)
+    for attempt in range(8):
+        if attempt:
+            # Encoded size scales roughly with the pixel count
+            scale *= max(0.5, 0.95 * math.sqrt(max_bytes / len(image_bytes)))
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        resized = image if scale >= 1 else cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        if two_tone and resized is not image:
+            # Area averaging leaves gray edges; keep the page two-tone
+            cv2.threshold(resized, 127, 255, cv2.THRESH_BINARY, dst=resized)
+        image_bytes, image_format = _compact_encode(resized, quality, two_tone)
+        if not max_bytes or len(image_bytes) <= max_bytes or max(size) <= 1:
+            break
+
+    over_budget = bool(max_bytes) and len(image_bytes) > max_bytes
+    if over_budget:
+        logging.warning(
+            f"Upload image is {len(image_bytes)} bytes at {resized.shape[1]}x{resized.shape[0]}, "
+            f"over max_bytes {max_bytes}"
+        )
+    return image_bytes, {
+        "format": image_format,
+        "mimetype": IMAGE_FORMATS[image_format]["mimetype"],
+        "width": resized.shape[1],
+        "height": resized.shape[0],
+        "scale": round(min(scale, 1.0), 4),
+        "bytes": len(image_bytes),
+        "over_budget": over_budget,
+    }
+
+
+def fit_image_data(image_data, upload, source_dpi=None):
+    """Downscale and re-encode a base64 image for upload, returning (image_data, info)."""
+    image = decode_image(base64.b64decode(image_data))
+    if source_dpi and not upload.get("source_dpi"):
+        upload = dict(upload, source_dpi=source_dpi)
+    image_bytes, info = encode_for_upload(image, **upload)
+    return base64.b64encode(image_bytes).decode('utf-8'), info
+
+
+def pixmap_to_ndarray(pix):
+    """
+    Wraps the sample buffer of a PyMuPDF pixmap as a NumPy array without copying.
+
+    The array is (height, width) for single-channel pixmaps and
+    (height, width, n) otherwise, in the pixmap's own channel order (RGB).
+    It shares memory with the pixmap, which must outlive it.
+    """
+    samples = np.frombuffer(pix.samples_mv, np.uint8)
+    if pix.n == 1:
+        return samples.reshape(pix.height, pix.width)
+    return samples.reshape(pix.height, pix.width, pix.n)
+
+
+def _render_array(page, page_dpi, colorspace, pipeline):
+    """Render a page and wrap it as the array the pipeline expects, returning (array, pixmap)."""
+    zoom = page_dpi / 72
+    pix = page.get_pixmap(
+        matrix=fitz.Matrix(zoom, zoom), colorspace=COLORSPACES[colorspace], alpha=False
+    )
+    image = pixmap_to_ndarray(pix)
+    if image.ndim == 3 and pipeline.decode_grayscale:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    elif image.ndim == 3:
+        # The pipeline works in OpenCV's BGR order; swap in place
+        cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=image)
+    elif colorspace == "bilevel":
+        cv2.threshold(image, BILEVEL_THRESHOLD - 1, 255, cv2.THRESH_BINARY, dst=image)
+    return image, pix
+
+
+def iter_preprocessed_pages(pdf_source, pipeline, dpi=300, pages=None, max_pages=None,
+                            max_pixels=None, min_dpi=None, colorspace="rgb", extract_images=False):
+    """
+    Renders PDF pages and runs a preprocessing pipeline on them in-process.
+
+    Each page pixmap is wrapped as an array (see pixmap_to_ndarray) and the
+    pipeline runs on it directly, so a page is encoded exactly once, after
+    the last step (see Pipeline.encode), instead of being encoded at render time and
+    decoded again for preprocessing. Color pages are converted to
+    grayscale right after rendering when the pipeline starts by dropping
+    color, with cv2.cvtColor, giving the same pixels as the grayscale op. With
+    extract_images, scanned pages that are one full-page image are decoded
+    from that image instead of being rendered (see extract_page_image).
+
+    Args:
+        pdf_source: Path to the PDF file, or its content as bytes
+        pipeline: Pipeline from compile_pipeline
+        dpi, pages, max_pages, max_pixels, min_dpi, colorspace,
+            extract_images: Render settings, as for
+            shared_code.utils.iter_pdf_pages
+
+    Yields:
+        tuple: (page_number, image_bytes, metadata) where metadata has
+            width, height, dpi, colorspace, page_count, extracted, the
+            pipeline timings, format and mimetype, upload when fitting for
+            upload and, in auto mode, quality, pipeline and blank
+    """
+    validate_colorspace(colorspace)
+
+    pdf_document = open_pdf(pdf_source)
+    try:
+        for page_num in parse_page_selection(pages, len(pdf_document), max_pages):
+            page = pdf_document.load_page(page_num)
+            started = time.perf_counter()
+            extracted = None
+            if extract_images:
+                extracted = extract_page_image(pdf_document, page, colorspace, max_pixels)
+            if extracted is not None:
+                # Decode the scan's own image; nothing is rendered
+                pix = None
+                page_dpi = extracted[1]["dpi"]
+                image = decode_image(extracted[0], pipeline.input_colorspace)
+                timings = [{"op": "extract", "ms": round((time.perf_counter() - started) * 1000, 3)}]
+            else:
+                page_dpi = page_render_dpi(page.rect, dpi, max_pixels, min_dpi)
+                image, pix = _render_array(page, page_dpi, colorspace, pipeline)
+                timings = [{"op": "render", "ms": round((time.perf_counter() - started) * 1000, 3)}]
+
+            image, report = pipeline.process(image)
+            report["timings"] = timings + report["timings"]
+            image_bytes = pipeline.encode(image, report, source_dpi=page_dpi)
+
+            metadata = {
+                "width": image.shape[1],
+                "height": image.shape[0],
+                "dpi": page_dpi,
+                "colorspace": colorspace,
+                "page_count": len(pdf_document),
+                "extracted": extracted is not None,
+                **report,
+            }
+            # Release the pixmap before rendering the next page
+            del image, pix
+            yield page_num + 1, image_bytes, metadata
+    finally:
+        pdf_document.close()
+
+
+def preprocess_batch(images, options=None, max_workers=None, pipeline=None):
+    """
+    Preprocesses a batch of base64 images concurrently in a thread pool.
+
+    Each item is either a base64 string or a dict with image_data and
+    optionally its own options (merged over the shared options) and a
+    page_number that is echoed back. A failing image does not fail the batch.
+
+    Args:
+        images: List of base64 strings or dicts as described above
+        options: Preprocessing options shared by every image
+        max_workers: Number of threads (default and maximum PREPROCESS_WORKERS)
+        pipeline: Already compiled pipeline for the shared options
+
+    Returns:
+        list: One dict per input, in input order, with index (and
+            page_number if given) plus either processed_image and
+            timings or error
+
+    Raises:
+        ValueError: If the shared options do not compile
+    """
+    options = options or {}
+    # Compiled once and shared by every image without its own options
+    pipeline = pipeline or compile_pipeline(options)
+
+    def run(index, item):
+        if isinstance(item, dict):
+            image_data = item.get('image_data')
+            item_options = item.get('options')
+        else:
+            image_data = item
+            item_options = None
+
+        result = {"index": index}
+        if isinstance(item, dict) and 'page_number' in item:
+            result['page_number'] = item['page_number']
+        if not image_data:
+            result['error'] = "No image data provided"
+            return result
+        try:
+            item_pipeline = compile_pipeline({**options, **item_options}) if item_options else pipeline
+            result.update(preprocess_image_data(image_data, item_pipeline))
+        except Exception as e:
+            logging.error(f"Error preprocessing image {index}: {str(e)}")
+            result['error'] = str(e)
+        return result
+
+    workers = max(1, min(max_workers or PREPROCESS_WORKERS, PREPROCESS_WORKERS, len(images) or 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run, range(len(images)), images))
@@ -0,0 +1,285 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# Size budgets for rendered pages kept between requests
+RENDER_CACHE_MEMORY_MB = float(os.getenv("RENDER_CACHE_MEMORY_MB", "128"))
+# The disk budget is per process: each process indexes the directory on its
+# own, so processes sharing RENDER_CACHE_DIR can together use up to
+# RENDER_CACHE_DISK_MB each
+RENDER_CACHE_DISK_MB = float(os.getenv("RENDER_CACHE_DISK_MB", "1024"))
+# The disk tier is only used when a cache directory is configured
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR")
+# Age after which a leftover temp file in the cache directory is assumed to
+# belong to a write that died, rather than one still in progress elsewhere
+STALE_TEMP_SECONDS = 600
+
+
+def document_hash(pdf_source):
+    """Return the SHA-256 of a PDF given as a file path or as bytes/memoryview."""
+    digest = hashlib.sha256()
+    if isinstance(pdf_source, (bytes, bytearray, memoryview)):
+        digest.update(pdf_source)
+    else:
+        with open(pdf_source, "rb") as pdf_file:
+            for block in iter(lambda: pdf_file.read(1024 * 1024), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def make_cache_key(doc_hash, page_number, render_options):
+    """
+    Builds the cache key of a rendered page.
+
+    The key covers the document content, the page and every render option
+    (DPI, color mode, codec and codec settings), so any change to how a page
+    is rendered produces a different key.
+    """
+    options = json.dumps(render_options, sort_keys=True)
+    return hashlib.sha256(f"{doc_hash}:{page_number}:{options}".encode()).hexdigest()
+
+
+class MemoryTier:
+    """In-process LRU store of rendered pages bounded by total image bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, image_bytes, metadata):
+        if len(image_bytes) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key)[0])
+        self.entries[key] = (image_bytes, metadata)
+        self.size += len(image_bytes)
+        while self.size > self.max_bytes:
+            _, (evicted_bytes, _) = self.entries.popitem(last=False)
+            self.size -= len(evicted_bytes)
+
+
+class DiskTier:
+    """
+    Local-disk LRU store of rendered pages bounded by total file size.
+
+    Each entry is one file holding a JSON metadata header followed by the
+    image bytes. Recency is tracked with the file modification time, which is
+    refreshed on every hit, so the LRU order survives process restarts.
+    Unreadable entries and the temp files of failed writes are deleted, so
+    files the index no longer counts do not pile up outside the budget.
+
+    The lock only guards the in-memory index; files are read, written and
+    removed outside it, so one slow page does not hold up the others. An
+    entry whose file goes missing in between is dropped on its next read.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Rebuild the LRU index from whatever a previous process left behind
+        self.entries = OrderedDict()
+        self.size = 0
+        files = []
+        stale_before = time.time() - STALE_TEMP_SECONDS
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+                if name.endswith(".page"):
+                    files.append((stat.st_mtime, name[:-len(".page")], stat.st_size))
+                elif name.endswith(".tmp") and stat.st_mtime < stale_before:
+                    # Left behind by a process that died mid-write
+                    os.remove(path)
+            except OSError as e:
+                logging.warning(f"Error scanning disk cache file {name}: {str(e)}")
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.page")
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as page_file:
+                header_length = int.from_bytes(page_file.read(4), "big")
+                metadata = json.loads(page_file.read(header_length))
+                image_bytes = page_file.read()
+            os.utime(path)
+        except (OSError, ValueError):
+            # Removed or corrupted behind our back; treat as a miss and drop
+            # the file too, or it would take disk space outside the budget
+            with self.lock:
+                if key in self.entries:
+                    self.size -= self.entries.pop(key)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.warning(f"Error removing unreadable cached page {key}: {str(e)}")
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return image_bytes, metadata
+
+    def put(self, key, image_bytes, metadata):
+        header = json.dumps(metadata).encode()
+        size = 4 + len(header) + len(image_bytes)
+        if size > self.max_bytes:
+            return
+
+        # Write to a temp file first so readers never see a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as page_file:
+                page_file.write(len(header).to_bytes(4, "big"))
+                page_file.write(header)
+                page_file.write(image_bytes)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)
+            self.entries[key] = size
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted_key, evicted_size = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                evicted.append(evicted_key)
+        for evicted_key in evicted:
+            try:
+                os.remove(self._path(evicted_key))
+            except FileNotFoundError:
+                # Already dropped by a concurrent read or eviction
+                pass
+            except OSError as e:
+                logging.warning(f"Error evicting cached page {evicted_key}: {str(e)}")
+
+    def usage(self):
+        with self.lock:
+            return len(self.entries), self.size
+
+
+class RenderCache:
+    """
+    Two-tier (memory, then local disk) LRU cache of rendered PDF pages.
+
+    Values are (image_bytes, metadata) tuples keyed by make_cache_key. Disk
+    hits are promoted to the memory tier. A tier with a zero budget is off.
+    The cache lock covers the memory tier and the counters; the disk tier
+    locks its own index and does its file I/O without holding either lock.
+    """
+
+    def __init__(self, memory_bytes=0, disk_directory=None, disk_bytes=0):
+        self.memory = MemoryTier(memory_bytes) if memory_bytes > 0 else None
+        self.disk = DiskTier(disk_directory, disk_bytes) if disk_directory and disk_bytes > 0 else None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.memory is not None or self.disk is not None
+
+    def contains(self, key):
+        """Check whether key is cached without loading it or counting a hit/miss."""
+        with self.lock:
+            if self.memory and key in self.memory.entries:
+                return True
+        return bool(self.disk and self.disk.contains(key))
+
+    def record_miss(self):
+        """Count a miss for a page that was rendered without calling get."""
+        with self.lock:
+            self.misses += 1
+
+    def get(self, key):
+        """Return the cached (image_bytes, metadata) for key, or None on a miss."""
+        with self.lock:
+            entry = self.memory.get(key) if self.memory else None
+            if entry is not None:
+                self.hits += 1
+                return entry[0], dict(entry[1])
+        if self.disk:
+            entry = self.disk.get(key)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            if self.memory:
+                self.memory.put(key, *entry)
+            self.hits += 1
+            return entry[0], dict(entry[1])
+
+    def put(self, key, image_bytes, metadata):
+        """Store a rendered page in every enabled tier."""
+        if self.memory:
+            with self.lock:
+                self.memory.put(key, image_bytes, dict(metadata))
+        if self.disk:
+            try:
+                self.disk.put(key, image_bytes, metadata)
+            except OSError as e:
+                logging.warning(f"Error writing rendered page to disk cache: {str(e)}")
+
+    def stats(self):
+        """Return cumulative hit/miss counters and tier usage."""
+        disk_entries, disk_bytes = self.disk.usage() if self.disk else (0, 0)
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_entries": len(self.memory.entries) if self.memory else 0,
+                "memory_bytes": self.memory.size if self.memory else 0,
+                "disk_entries": disk_entries,
+                "disk_bytes": disk_bytes,
+            }
+
+
+_render_cache = None
+_render_cache_lock = threading.Lock()
+
+
+def get_render_cache():
+    """Return the process-wide render cache configured from the environment."""
+    global _render_cache
+    with _render_cache_lock:
+        if _render_cache is None:
+            _render_cache = RenderCache(
+                memory_bytes=int(RENDER_CACHE_MEMORY_MB * 1024 * 1024),
+                disk_directory=RENDER_CACHE_DIR,
+                disk_bytes=int(RENDER_CACHE_DISK_MB * 1024 * 1024),
+            )
+        return _render_cache
@@ -0,0 +1,187 @@
+import os
+import asyncio
+import base64
+import logging
+import requests
+from shared_code.utils import convert_pdf_to_images
+from shared_code.preprocessing import preprocess_batch
+from shared_code.document_intelligence import (
+    analyze_layout, analyze_document, analyze_layout_async, analyze_document_async
+)
+
+# How process_document runs its stages: "local" calls them in-process,
+# "http" posts to the function endpoints (to spread the work over hosts)
+STAGE_MODES = ("local", "http")
+PROCESS_DOCUMENT_STAGES = os.getenv("PROCESS_DOCUMENT_STAGES", "local")
+# Host the http mode posts to; defaults to the host serving the request
+STAGE_BASE_URL = os.getenv("STAGE_BASE_URL")
+
+
+def validate_stage_mode(mode):
+    if mode not in STAGE_MODES:
+        raise ValueError(f"Unsupported stage mode '{mode}'; expected one of {', '.join(STAGE_MODES)}")
+
+
+def get_stage_runner(mode=None, base_url=None):
+    """
+    Return the stage runner for mode (default PROCESS_DOCUMENT_STAGES).
+
+    Both runners return the JSON the matching endpoint would respond with,
+    with failures reported as {"error": ...} rather than raised. Every
+    stage also has an *_async coroutine for the async handlers.
+    """
+    mode = mode or PROCESS_DOCUMENT_STAGES
+    validate_stage_mode(mode)
+    if mode == "http":
+        return HttpStages(STAGE_BASE_URL or base_url)
+    return LocalStages()
+
+
+class Stages:
+    """
+    Async forms of the stages. By default the blocking stage runs on a
+    worker thread so the event loop stays free; runners override the ones
+    they can await natively.
+    """
+
+    async def convert_pdf_async(self, pdf_bytes, conversion_options=None):
+        return await asyncio.to_thread(self.convert_pdf, pdf_bytes, conversion_options)
+
+    async def preprocess_batch_async(self, images, options):
+        return await asyncio.to_thread(self.preprocess_batch, images, options)
+
+    async def analyze_layout_async(self, image_data):
+        return await asyncio.to_thread(self.analyze_layout, image_data)
+
+    async def analyze_content_async(self, image_data, model):
+        return await asyncio.to_thread(self.analyze_content, image_data, model)
+
+
+class LocalStages(Stages):
+    """
+    Runs the stages as Python calls in the current worker.
+
+    Nothing goes through JSON or another worker slot, so a busy host can not
+    deadlock on requests to itself. Document Intelligence calls use the aio
+    client when awaited.
+    """
+
+    mode = "local"
+
+    def convert_pdf(self, pdf_bytes, conversion_options=None):
+        try:
+            result = convert_pdf_to_images(pdf_bytes, return_base64=True, **(conversion_options or {}))
+        except Exception as e:
+            logging.error(f"Error converting PDF: {str(e)}")
+            return {"error": f"Error converting PDF: {str(e)}"}
+        return {
+            "message": f"Converted {result['rendered_count']} of {result['image_count']} pages to images",
+            "image_count": result['image_count'],
+            "rendered_count": result['rendered_count'],
+            "cache": result['cache'],
+            "image_format": result['image_format'],
+            "mimetype": result['mimetype'],
+            "colorspace": result['colorspace'],
+            "images": result['image_data'],
+        }
+
+    def preprocess_batch(self, images, options):
+        try:
+            return {"results": preprocess_batch(images, options)}
+        except Exception as e:
+            return {"error": f"Error preprocessing image: {str(e)}"}
+
+    def analyze_layout(self, image_data):
+        try:
+            return {"result": analyze_layout(base64.b64decode(image_data))}
+        except Exception as e:
+            logging.error(f"Error analyzing document layout: {str(e)}")
+            return {"error": f"Error analyzing layout: {str(e)}"}
+
+    def analyze_content(self, image_data, model):
+        try:
+            return {"model": model, "result": analyze_document(base64.b64decode(image_data), model)}
+        except Exception as e:
+            logging.error(f"Error analyzing document: {str(e)}")
+            return {"error": f"Error analyzing content: {str(e)}"}
+
+    async def analyze_layout_async(self, image_data):
+        try:
+            return {"result": await analyze_layout_async(base64.b64decode(image_data))}
+        except Exception as e:
+            logging.error(f"Error analyzing document layout: {str(e)}")
+            return {"error": f"Error analyzing layout: {str(e)}"}
+
+    async def analyze_content_async(self, image_data, model):
+        try:
+            return {"model": model, "result": await analyze_document_async(base64.b64decode(image_data), model)}
+        except Exception as e:
+            logging.error(f"Error analyzing document: {str(e)}")
+            return {"error": f"Error analyzing content: {str(e)}"}
+
+
+class HttpStages(Stages):
+    """Runs the stages by calling the function endpoints under base_url."""
+
+    mode = "http"
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        # Reuse connections across the calls of one document
+        self.session = requests.Session()
+
+    def convert_pdf(self, pdf_bytes, conversion_options=None):
+        """Call the ConvertPdfToImages function."""
+        params = dict(conversion_options or {})
+        if isinstance(params.get('pages'), list):
+            params['pages'] = ",".join(str(page) for page in params['pages'])
+        try:
+            response = self.session.post(
+                f"{self.base_url}/api/convert_pdf_to_images",
+                data=pdf_bytes,
+                params=params,
+                headers={"Content-Type": "application/pdf"},
+                timeout=30  # Increased from 10 to 30 seconds
+            )
+            return response.json()
+        except Exception as e:
+            return {"error": f"Error converting PDF: {str(e)}"}
+
+    def preprocess_batch(self, images, options):
+        """Call the PreprocessImage function with a batch of images."""
+        try:
+            response = self.session.post(
+                f"{self.base_url}/api/preprocess_image",
+                json={"images": images, "options": options},
+                headers={"Content-Type": "application/json"},
+                timeout=30 + 5 * len(images)
+            )
+            return response.json()
+        except Exception as e:
+            return {"error": f"Error preprocessing image: {str(e)}"}
+
+    def analyze_layout(self, image_data):
+        """Call the AnalyzeLayout function."""
+        try:
+            response = self.session.post(
+                f"{self.base_url}/api/analyze_layout",
+                json={"image_data": image_data},
+                headers={"Content-Type": "application/json"},
+                timeout=45  # Increased from 10 to 45 seconds
+            )
+            return response.json()
+        except Exception as e:
+            return {"error": f"Error analyzing layout: {str(e)}"}
+
+    def analyze_content(self, image_data, model):
+        """Call the AnalyzeDocument function."""
+        try:
+            response = self.session.post(
+                f"{self.base_url}/api/analyze_document",
+                json={"image_data": image_data, "model": model},
+                headers={"Content-Type": "application/json"},
+                timeout=60  # Increased from 10 to 60 seconds
+            )
+            return response.json()
+        except Exception as e:
+            return {"error": f"Error analyzing content: {str(e)}"}
@@ -2,10 +2,19 @@ import os
 import logging
 import tempfile
 import base64
+import itertools
+import math
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
 import fitz  # PyMuPDF
-from PIL import Image  # For image processing
+from PIL import Image  # For image encoding
 from dotenv import load_dotenv
+from shared_code.render_cache import document_hash, make_cache_key, get_render_cache
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,63 +23,822 @@ load_dotenv()
 DOCUMENT_INTELLIGENCE_ENDPOINT = os.getenv("DOCUMENT_INTELLIGENCE_ENDPOINT")
 DOCUMENT_INTELLIGENCE_KEY = os.getenv("DOCUMENT_INTELLIGENCE_KEY")
 
+# Number of processes used to rasterize a PDF (1 renders in the calling process);
+# also the size of the process pool shared by all requests
+PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", "1"))
+# Pages rendered per task handed to the process pool
+PDF_RENDER_BATCH_PAGES = int(os.getenv("PDF_RENDER_BATCH_PAGES", "2"))
+# Threads encoding pages while the next ones render (0 renders and encodes in turn)
+PDF_ENCODE_WORKERS = int(os.getenv("PDF_ENCODE_WORKERS", "0"))
+# Pages that may be rendered ahead of the consumer when encode threads are used
+PDF_PIPELINE_DEPTH = int(os.getenv("PDF_PIPELINE_DEPTH", "2"))
+# Pages per sub-PDF when whole PDFs are sent to Document Intelligence, and the
+# largest sub-PDF sent (the free tier takes 4 MB per request, S0 500 MB)
+PDF_CHUNK_PAGES = int(os.getenv("PDF_CHUNK_PAGES", "10"))
+PDF_CHUNK_MAX_MB = float(os.getenv("PDF_CHUNK_MAX_MB", "4"))
 
-def convert_pdf_to_images(pdf_path, output_folder=None, dpi=300, return_base64=False):
+
+# Output codecs supported for rendered pages
+IMAGE_FORMATS = {
+    "png": {"extension": ".png", "mimetype": "image/png"},
+    "jpeg": {"extension": ".jpg", "mimetype": "image/jpeg"},
+    "webp": {"extension": ".webp", "mimetype": "image/webp"},
+    "tiff-g4": {"extension": ".tif", "mimetype": "image/tiff"},
+}
+
+# Embedded image types (PyMuPDF extension -> IMAGE_FORMATS key) that can be
+# passed on as they are stored in the PDF
+EXTRACTED_IMAGE_FORMATS = {"jpeg": "jpeg", "png": "png"}
+
+# Pixel layout of a pixmap by component count (colors plus alpha)
+PIXMAP_MODES = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}
+
+# Render colorspaces; bilevel pages are rendered in grayscale and thresholded to 1 bit
+COLORSPACES = {
+    "rgb": fitz.csRGB,
+    "gray": fitz.csGRAY,
+    "bilevel": fitz.csGRAY,
+}
+BILEVEL_THRESHOLD = 128
+
+
+def validate_colorspace(colorspace):
+    """Raise ValueError if the render colorspace is not supported."""
+    if colorspace not in COLORSPACES:
+        raise ValueError(
+            f"Unsupported colorspace '{colorspace}'. "
+            f"Supported colorspaces: {', '.join(COLORSPACES)}"
+        )
+
+
+def validate_image_format(image_format, compression_level=None, quality=None):
+    """Raise ValueError if the output format or its settings are not supported."""
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(
+            f"Unsupported image format '{image_format}'. "
+            f"Supported formats: {', '.join(IMAGE_FORMATS)}"
+        )
+    if compression_level is not None and not 0 <= compression_level <= 9:
+        raise ValueError("compression_level must be between 0 and 9")
+    if quality is not None and not 1 <= quality <= 100:
+        raise ValueError("quality must be between 1 and 100")
+
+
+def encode_pil_image(pil_image, image_format="png", compression_level=None, quality=None):
+    """
+    Encodes a PIL image in one of the IMAGE_FORMATS.
+    
+    Args:
+        pil_image: PIL image to encode
+        image_format: One of "png", "jpeg", "webp" or "tiff-g4"
+        compression_level: PNG zlib level 0-9 (default 6)
+        quality: JPEG/WebP quality 1-100 (default 85 for JPEG, 80 for WebP)
+        
+    Returns:
+        bytes: The encoded image
+    """
+    validate_image_format(image_format, compression_level, quality)
+    buffered = BytesIO()
+    
+    if image_format == "png":
+        level = 6 if compression_level is None else compression_level
+        pil_image.save(buffered, format="PNG", compress_level=level)
+    elif image_format == "jpeg":
+        if pil_image.mode not in ("L", "RGB"):
+            pil_image = pil_image.convert("L" if pil_image.mode in ("1", "LA") else "RGB")
+        pil_image.save(buffered, format="JPEG", quality=quality or 85)
+    elif image_format == "webp":
+        pil_image.save(buffered, format="WEBP", quality=quality or 80)
+    elif image_format == "tiff-g4":
+        # CCITT Group 4 only stores bilevel images; threshold without dithering
+        if pil_image.mode != "1":
+            pil_image = pil_image.convert("L").convert("1", dither=0)
+        pil_image.save(buffered, format="TIFF", compression="group4")
+    
+    return buffered.getvalue()
+
+
+def encode_pixmap(pix, image_format="png", compression_level=None, quality=None, bilevel=False):
+    """
+    Encodes a PyMuPDF pixmap exactly once in the requested output format.
+    
+    Default PNG output uses PyMuPDF's native encoder. Other formats wrap the
+    pixmap samples in a PIL image without copying them and encode from there.
+    
+    Args:
+        pix: PyMuPDF pixmap to encode
+        image_format: One of IMAGE_FORMATS
+        compression_level: PNG zlib level 0-9
+        quality: JPEG/WebP quality 1-100
+        bilevel: Threshold a grayscale pixmap to 1 bit per pixel before encoding
+        
+    Returns:
+        bytes: The encoded image
+    """
+    validate_image_format(image_format, compression_level, quality)
+    if image_format == "png" and compression_level is None and not bilevel:
+        return pix.tobytes("png")
+    return encode_samples(
+        pix.samples_mv, pix.width, pix.height, pix.n, pix.stride,
+        image_format, compression_level, quality, bilevel
+    )
+
+
+def encode_samples(samples, width, height, n, stride, image_format="png", compression_level=None,
+                   quality=None, bilevel=False):
+    """
+    Encodes raw pixmap samples with PIL, wrapping them without copying.
+    
+    Unlike encode_pixmap this never calls into MuPDF, so it is safe to run
+    on a thread other than the one rendering (see iter_pdf_pages).
+    
+    Args:
+        samples: Sample buffer (bytes or memoryview)
+        width, height, n, stride: Pixmap geometry and component count
+        image_format, compression_level, quality, bilevel: As for encode_pixmap
+        
+    Returns:
+        bytes: The encoded image
+    """
+    mode = PIXMAP_MODES[n]
+    pil_image = Image.frombuffer(mode, (width, height), samples, "raw", mode, stride, 1)
+    if bilevel:
+        lookup = [0] * BILEVEL_THRESHOLD + [255] * (256 - BILEVEL_THRESHOLD)
+        pil_image = pil_image.convert("L").point(lookup, "1")
+    return encode_pil_image(pil_image, image_format, compression_level, quality)
+
+
+def open_pdf(pdf_source):
+    """
+    Opens a PDF with PyMuPDF from a file path or from in-memory bytes.
+    
+    Args:
+        pdf_source: Path to the PDF file, or its content as bytes, bytearray
+            or memoryview (opened from memory, nothing is written to disk)
+        
+    Returns:
+        fitz.Document: The opened document
+    """
+    if isinstance(pdf_source, memoryview):
+        # Older PyMuPDF releases only accept bytes-like streams, not memoryviews
+        pdf_source = pdf_source.tobytes()
+    if isinstance(pdf_source, (bytes, bytearray)):
+        return fitz.open(stream=pdf_source, filetype="pdf")
+    return fitz.open(pdf_source)
+
+
+def parse_page_selection(pages, page_count, max_pages=None):
+    """
+    Resolves a page selection to the 0-based page indexes to render.
+    
+    Args:
+        pages: None for every page, a string such as "1-3,10" or "5-" (open
+            ended), or a list of page numbers and range strings. Page
+            numbers are 1-based.
+        page_count: Total number of pages in the document
+        max_pages: Render at most this many of the selected pages
+        
+    Returns:
+        list: Sorted, de-duplicated 0-based page indexes
+        
+    Raises:
+        ValueError: If the selection is malformed or out of range
+    """
+    if pages is None or pages == "":
+        indexes = list(range(page_count))
+    else:
+        if isinstance(pages, str):
+            parts = pages.split(",")
+        elif isinstance(pages, int):
+            parts = [pages]
+        else:
+            parts = list(pages)
+        
+        selected = set()
+        for part in parts:
+            part = str(part).strip()
+            if not part:
+                continue
+            try:
+                if "-" in part:
+                    start, _, stop = part.partition("-")
+                    start = int(start) if start.strip() else 1
+                    stop = int(stop) if stop.strip() else page_count
+                else:
+                    start = stop = int(part)
+            except ValueError:
+                raise ValueError(f"Invalid page selection '{part}'")
+            if start < 1 or stop > page_count or start > stop:
+                raise ValueError(
+                    f"Page selection '{part}' is outside the document's {page_count} pages"
+                )
+            selected.update(range(start - 1, stop))
+        indexes = sorted(selected)
+    
+    if max_pages is not None:
+        if max_pages < 1:
+            raise ValueError("max_pages must be at least 1")
+        indexes = indexes[:max_pages]
+    return indexes
+
+
+def split_pdf(pdf_source, pages=None, max_pages=None, chunk_pages=None, max_bytes=None):
+    """
+    Splits the selected pages of a PDF into sub-PDFs without rasterizing them.
+    
+    Pages are copied as they are (text, fonts and images untouched) into
+    sub-PDFs of at most chunk_pages pages. A sub-PDF that is still larger
+    than max_bytes is halved until it fits or is a single page.
+    
+    Args:
+        pdf_source: Path to the PDF file, or its content as bytes or memoryview
+        pages: Page selection such as "1-3,10" (see parse_page_selection)
+        max_pages: Use at most this many of the selected pages
+        chunk_pages: Pages per sub-PDF (default PDF_CHUNK_PAGES)
+        max_bytes: Size limit per sub-PDF (default PDF_CHUNK_MAX_MB)
+        
+    Returns:
+        list: (page_numbers, pdf_bytes) per sub-PDF in page order, where
+            page_numbers are the 1-based numbers in the original document
+            of the sub-PDF's pages
+    """
+    chunk_pages = max(1, chunk_pages or PDF_CHUNK_PAGES)
+    max_bytes = max_bytes or int(PDF_CHUNK_MAX_MB * 1024 * 1024)
+    pdf_document = open_pdf(pdf_source)
+    try:
+        page_indexes = parse_page_selection(pages, pdf_document.page_count, max_pages)
+        
+        def build(indexes):
+            chunk = fitz.open()
+            try:
+                # Copy runs of consecutive pages in one call each
+                run_start = previous = indexes[0]
+                for index in indexes[1:] + [None]:
+                    if index is None or index != previous + 1:
+                        chunk.insert_pdf(pdf_document, from_page=run_start, to_page=previous)
+                        run_start = index
+                    previous = index
+                # Drop objects only used by pages left out
+                return chunk.tobytes(garbage=3, deflate=True)
+            finally:
+                chunk.close()
+        
+        chunks = []
+        pending = [page_indexes[start:start + chunk_pages]
+                   for start in range(0, len(page_indexes), chunk_pages)]
+        while pending:
+            indexes = pending.pop(0)
+            chunk_bytes = build(indexes)
+            if len(chunk_bytes) > max_bytes and len(indexes) > 1:
+                middle = len(indexes) // 2
+                pending[:0] = [indexes[:middle], indexes[middle:]]
+                continue
+            chunks.append(([index + 1 for index in indexes], chunk_bytes))
+        return chunks
+    finally:
+        pdf_document.close()
+
+
+def page_render_dpi(page_rect, dpi, max_pixels=None, min_dpi=None):
+    """
+    Picks the DPI to render a page at so its pixmap stays within a pixel budget.
+    
+    Pages that fit the budget at the requested DPI keep it; oversized pages
+    (engineering drawings, plats) are scaled down until width x height is at
+    most max_pixels, but never below min_dpi so small text stays legible.
+    
+    Args:
+        page_rect: Page rectangle in points (1/72 inch), as rendered
+        dpi: Requested resolution
+        max_pixels: Pixel budget per page (None keeps the requested DPI)
+        min_dpi: Lowest DPI the budget may push a page down to
+        
+    Returns:
+        float: The DPI to render at
+    """
+    if not max_pixels:
+        return dpi
+    
+    # PyMuPDF uses 72 DPI as base; pixel size is the page size times the zoom
+    def pixel_count(render_dpi):
+        irect = (page_rect * fitz.Matrix(render_dpi / 72, render_dpi / 72)).irect
+        return irect.width * irect.height
+    
+    render_dpi = dpi
+    if pixel_count(render_dpi) > max_pixels:
+        area_in_square_inches = (page_rect.width / 72) * (page_rect.height / 72)
+        render_dpi = math.floor(math.sqrt(max_pixels / area_in_square_inches) * 100) / 100
+        # Step down past rounding of the pixmap edges
+        while render_dpi > 1 and pixel_count(render_dpi) > max_pixels:
+            render_dpi = round(render_dpi - 0.01, 2)
+    if min_dpi:
+        render_dpi = max(render_dpi, min_dpi)
+    return render_dpi
+
+
+def extract_page_image(pdf_document, page, colorspace="rgb", max_pixels=None):
+    """
+    Returns the embedded image of a page that is nothing but one full-page image.
+    
+    Typical of scanned PDFs: the page holds a single upright image without
+    a soft mask covering the whole page, no vector drawings and at most
+    invisible (OCR) text. The original image bytes are returned as stored,
+    without decoding; PyMuPDF hands back non-JPEG images losslessly as PNG.
+    Pages that do not qualify, or whose image does not suit the requested
+    colorspace or pixel budget, return None and should be rendered.
+    
+    Args:
+        pdf_document: Open PyMuPDF document
+        page: Page of pdf_document
+        colorspace: Requested colorspace; "gray" and "bilevel" only accept
+            images that already are
+        max_pixels: Pixel budget the image must fit
+        
+    Returns:
+        tuple: (image_bytes, metadata) or None, where metadata has width,
+            height, dpi, colorspace, format and mimetype
+    """
+    images = page.get_images(full=True)
+    if len(images) != 1 or page.rotation:
+        return None
+    xref, smask = images[0][0], images[0][1]
+    if smask:
+        return None
+    
+    placements = page.get_image_rects(xref, transform=True)
+    if len(placements) != 1:
+        return None
+    rect, matrix = placements[0]
+    # Upright and unflipped, covering (nearly) the whole page
+    if matrix.b or matrix.c or matrix.a <= 0 or matrix.d <= 0:
+        return None
+    if abs(rect & page.rect) < 0.98 * abs(page.rect):
+        return None
+    if page.get_drawings():
+        return None
+    if any(span["type"] != 3 for span in page.get_texttrace()):
+        return None
+    
+    extracted = pdf_document.extract_image(xref)
+    if not extracted or extracted["ext"] not in EXTRACTED_IMAGE_FORMATS:
+        return None
+    components, bits = extracted["colorspace"], extracted["bpc"]
+    if components not in (1, 3):
+        return None
+    if colorspace == "gray" and components != 1 or colorspace == "bilevel" and bits != 1:
+        return None
+    width, height = extracted["width"], extracted["height"]
+    if max_pixels and width * height > max_pixels:
+        return None
+    
+    image_format = EXTRACTED_IMAGE_FORMATS[extracted["ext"]]
+    return extracted["image"], {
+        "width": width,
+        "height": height,
+        "dpi": round(width * 72 / page.rect.width, 2),
+        "colorspace": "bilevel" if bits == 1 else "gray" if components == 1 else "rgb",
+        "format": image_format,
+        "mimetype": IMAGE_FORMATS[image_format]["mimetype"],
+    }
+
+
+def _render_page(pdf_document, page_num, render_options, encode=True):
+    """
+    Render and encode a single page, returning (page_number, image_bytes, metadata).
+    
+    With encode=False the page is returned as (page_number, samples,
+    metadata), samples being a (bytes, width, height, n, stride) copy of the
+    pixmap for _encode_rendered; extracted page images are returned as bytes.
+    """
+    image_format = render_options["image_format"]
+    page = pdf_document.load_page(page_num)
+    
+    if render_options.get("extract_images"):
+        extracted = extract_page_image(
+            pdf_document, page, render_options["colorspace"], render_options["max_pixels"]
+        )
+        if extracted is not None:
+            img_data, metadata = extracted
+            metadata.update(page_count=len(pdf_document), extracted=True)
+            return page_num + 1, img_data, metadata
+    
+    dpi = page_render_dpi(
+        page.rect, render_options["dpi"], render_options["max_pixels"], render_options["min_dpi"]
+    )
+    
+    # Calculate zoom factor based on DPI (PyMuPDF uses 72 DPI as base)
+    zoom = dpi / 72
+    
+    # Render page to pixmap (image) without alpha, straight in the target
+    # colorspace, and encode it once
+    colorspace = render_options["colorspace"]
+    pix = page.get_pixmap(
+        matrix=fitz.Matrix(zoom, zoom), colorspace=COLORSPACES[colorspace], alpha=False
+    )
+    metadata = {
+        "width": pix.width,
+        "height": pix.height,
+        "dpi": dpi,
+        "colorspace": colorspace,
+        "format": image_format,
+        "mimetype": IMAGE_FORMATS[image_format]["mimetype"],
+        "page_count": len(pdf_document),
+        "extracted": False,
+    }
+    if not encode:
+        # Copy the samples so the pixmap is freed on the rendering thread
+        return page_num + 1, (pix.samples, pix.width, pix.height, pix.n, pix.stride), metadata
+    img_data = encode_pixmap(
+        pix, image_format, render_options["compression_level"], render_options["quality"],
+        bilevel=colorspace == "bilevel"
+    )
+    return page_num + 1, img_data, metadata
+
+
+def _encode_rendered(rendered, render_options):
+    """Encode a page rendered with encode=False, given the future of its render."""
+    page_number, payload, metadata = rendered.result()
+    if isinstance(payload, bytes):
+        return page_number, payload, metadata
+    img_data = encode_samples(
+        *payload, render_options["image_format"], render_options["compression_level"],
+        render_options["quality"], bilevel=metadata["colorspace"] == "bilevel"
+    )
+    return page_number, img_data, metadata
+
+
+def _iter_pipelined_pages(pdf_document, page_indexes, render_options, encode_workers, queue_depth,
+                          render_executor):
+    """
+    Render pages on one thread while other threads encode them.
+    
+    Pages are yielded in page order. At most queue_depth pages are rendered
+    or encoded ahead of the consumer, which bounds memory, and the consumer's
+    own work on a page (saving, base64) overlaps rendering the next ones.
+    The document is only touched by render_executor, a single thread owned
+    by the caller, which must send any other render of the document there.
+    """
+    encode_executor = ThreadPoolExecutor(max_workers=encode_workers)
+    remaining = iter(page_indexes)
+    pending = deque()
+    
+    def submit(page_num):
+        rendered = render_executor.submit(_render_page, pdf_document, page_num, render_options, False)
+        pending.append(encode_executor.submit(_encode_rendered, rendered, render_options))
+    
+    try:
+        for page_num in itertools.islice(remaining, max(1, queue_depth)):
+            submit(page_num)
+        while pending:
+            page = pending.popleft().result()
+            next_page = next(remaining, None)
+            if next_page is not None:
+                submit(next_page)
+            yield page
+    finally:
+        # The caller shuts the render thread down before closing the document
+        encode_executor.shutdown(cancel_futures=True)
+
+
+def _render_page_range(pdf_source, page_indexes, render_options):
+    """Render a range of pages in a worker process, opening the PDF independently."""
+    pdf_document = open_pdf(pdf_source)
+    try:
+        return [_render_page(pdf_document, page_num, render_options) for page_num in page_indexes]
+    finally:
+        pdf_document.close()
+
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def render_worker_limit():
+    """Most rendering processes a request may use: PDF_RENDER_WORKERS, capped at the CPU count."""
+    return max(1, min(PDF_RENDER_WORKERS, os.cpu_count() or 1))
+
+
+def get_render_pool():
+    """Return the process pool shared by all renders, creating it on first use."""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # Spawn rather than fork: the Functions worker is multi-threaded
+            _render_pool = ProcessPoolExecutor(
+                max_workers=render_worker_limit(), mp_context=multiprocessing.get_context("spawn")
+            )
+        return _render_pool
+
+
+def _discard_render_pool(pool):
+    """Drop a broken pool so the next render starts a fresh one."""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _iter_pooled_pages(pdf_source, page_indexes, render_options, workers, batch_pages):
+    """
+    Render pages on the shared process pool, yielding them in page order.
+    
+    Pages are submitted in batches of batch_pages, with at most two batches
+    per worker in flight, so a request neither floods the pool's queue nor
+    holds more than a few rendered pages it has not consumed yet.
+    """
+    pool = get_render_pool()
+    batches = (
+        page_indexes[start:start + batch_pages]
+        for start in range(0, len(page_indexes), max(1, batch_pages))
+    )
+    pending = deque()
+    
+    def submit(batch):
+        pending.append(pool.submit(_render_page_range, pdf_source, batch, render_options))
+    
+    try:
+        for batch in itertools.islice(batches, 2 * workers):
+            submit(batch)
+        while pending:
+            rendered = pending.popleft().result()
+            next_batch = next(batches, None)
+            if next_batch is not None:
+                submit(next_batch)
+            yield from rendered
+    except BrokenProcessPool:
+        _discard_render_pool(pool)
+        raise
+    finally:
+        # The pool is shared, so only this request's queued batches are dropped
+        for future in pending:
+            future.cancel()
+
+
+def iter_pdf_pages(pdf_source, dpi=300, image_format="png", compression_level=None, quality=None,
+                   workers=None, pages=None, max_pages=None, use_cache=True,
+                   max_pixels=None, min_dpi=None, colorspace="rgb", extract_images=False,
+                   encode_workers=None, queue_depth=None):
+    """
+    Renders a PDF one page at a time, yielding each page as encoded image bytes.
+    
+    With a single worker only one page pixmap is alive at any moment: it is
+    released before the next page is rendered, so peak memory depends on the
+    largest page rather than on the page count.
+    
+    With several workers the pages to render are handed in small batches to
+    a process pool shared by all requests, each process opening the PDF on
+    its own. workers is capped at render_worker_limit() and bounds how many
+    batches the request has in flight. Pages are still yielded in page order
+    and are identical to the sequential output.
+    
+    With encode threads (and a single worker) rendering and encoding are
+    pipelined: one thread renders while the others encode, up to queue_depth
+    pages ahead of the consumer. Pages are still yielded in page order with
+    the same pixels; encoding then always goes through PIL (encode_samples)
+    because MuPDF must not be called from several threads.
+    
+    When pages or max_pages is given only the selected pages are loaded and
+    rendered; metadata["page_count"] still reports the whole document.
+    
+    When max_pixels is given the DPI is chosen per page (see page_render_dpi)
+    and metadata["dpi"] reports the DPI each page was actually rendered at.
+    
+    Rendered pages are looked up in, and added to, the shared render cache
+    (see shared_code.render_cache) keyed on the document content, the page
+    and the render options, so repeat renders of a document are lookups.
+    
+    Args:
+        pdf_source: Path to the PDF file, or its content as bytes or memoryview
+        dpi: Resolution for the output images (default 300)
+        image_format: Output codec, one of IMAGE_FORMATS (default "png")
+        compression_level: PNG zlib level 0-9
+        quality: JPEG/WebP quality 1-100
+        workers: Number of rendering processes (default PDF_RENDER_WORKERS,
+            capped at PDF_RENDER_WORKERS and the CPU count)
+        pages: Page selection such as "1-3,10" (see parse_page_selection)
+        max_pages: Render at most this many of the selected pages
+        use_cache: Whether to use the render cache (default True)
+        max_pixels: Per-page pixel budget that enables adaptive DPI
+        min_dpi: Lowest DPI adaptive mode may choose
+        colorspace: "rgb" (default), "gray" or "bilevel" (1 bit per pixel);
+            gray and bilevel are rendered directly in grayscale, which cuts
+            pixmap memory and encode time about 3x for text documents
+        extract_images: Pass on the embedded image of scanned pages made of
+            a single full-page image instead of rendering them (see
+            extract_page_image); such pages keep their original codec and
+            resolution
+        encode_workers: Threads encoding pages while the next ones render
+            (default PDF_ENCODE_WORKERS; 0 renders and encodes in turn)
+        queue_depth: Pages rendered ahead of the consumer when pipelining
+            (default PDF_PIPELINE_DEPTH)
+        
+    Yields:
+        tuple: (page_number, image_bytes, metadata) where page_number is
+            1-based, image_bytes is the encoded page and metadata is a dict
+            with width, height, dpi, colorspace, format, mimetype, page_count,
+            extracted and cached
+    """
+    validate_image_format(image_format, compression_level, quality)
+    validate_colorspace(colorspace)
+    render_options = {
+        "dpi": dpi,
+        "image_format": image_format,
+        "compression_level": compression_level,
+        "quality": quality,
+        "max_pixels": max_pixels,
+        "min_dpi": min_dpi,
+        "colorspace": colorspace,
+        "extract_images": extract_images,
+    }
+    # workers may come from an anonymous request: never more than the pool has
+    workers = min(PDF_RENDER_WORKERS if workers is None else workers, render_worker_limit())
+    encode_workers = PDF_ENCODE_WORKERS if encode_workers is None else encode_workers
+    queue_depth = PDF_PIPELINE_DEPTH if queue_depth is None else queue_depth
+    cache = get_render_cache() if use_cache else None
+    if cache is not None and not cache.enabled:
+        cache = None
+    
+    if isinstance(pdf_source, memoryview):
+        # Worker processes need a picklable copy of in-memory PDFs
+        pdf_source = pdf_source.tobytes()
+    
+    pdf_document = open_pdf(pdf_source)
+    pool_source = None
+    render_executor = None
+    pooled = iter(())
+    try:
+        page_indexes = parse_page_selection(pages, len(pdf_document), max_pages)
+        
+        cache_keys = {}
+        if cache:
+            doc_hash = document_hash(pdf_source)
+            cache_keys = {
+                page_num: make_cache_key(doc_hash, page_num + 1, render_options)
+                for page_num in page_indexes
+            }
+        
+        # Hand uncached pages to the process pool or the render/encode
+        # pipeline up front; they come back in page order
+        pooled_pages = set()
+        if workers > 1 or encode_workers > 0:
+            to_render = [
+                page_num for page_num in page_indexes
+                if not (cache and cache.contains(cache_keys[page_num]))
+            ]
+            if workers <= 1 and to_render:
+                render_executor = ThreadPoolExecutor(max_workers=1)
+                pooled = _iter_pipelined_pages(
+                    pdf_document, to_render, render_options, encode_workers, queue_depth,
+                    render_executor
+                )
+                pooled_pages = set(to_render)
+            elif len(to_render) > 1:
+                # Every batch reopens the PDF, so in-memory PDFs are written to
+                # a file once instead of being pickled into each task
+                if isinstance(pdf_source, bytes):
+                    pool_source = save_bytes_to_temp_file(pdf_source)
+                pooled = _iter_pooled_pages(
+                    pool_source or pdf_source, to_render, render_options, workers,
+                    PDF_RENDER_BATCH_PAGES
+                )
+                pooled_pages = set(to_render)
+        
+        for page_num in page_indexes:
+            entry = None
+            if page_num in pooled_pages:
+                _, image_bytes, metadata = next(pooled)
+                if cache:
+                    cache.record_miss()
+            else:
+                entry = cache.get(cache_keys[page_num]) if cache else None
+                if entry is not None:
+                    image_bytes, metadata = entry
+                elif render_executor is not None:
+                    # Evicted since the plan was made; MuPDF documents are not
+                    # thread-safe, so render it on the pipeline's render thread
+                    _, image_bytes, metadata = render_executor.submit(
+                        _render_page, pdf_document, page_num, render_options
+                    ).result()
+                else:
+                    # The pixmap is freed inside _render_page before the next page
+                    _, image_bytes, metadata = _render_page(pdf_document, page_num, render_options)
+            
+            if entry is None and cache:
+                cache.put(cache_keys[page_num], image_bytes, metadata)
+            metadata["cached"] = entry is not None
+            yield page_num + 1, image_bytes, metadata
+    finally:
+        if hasattr(pooled, "close"):
+            pooled.close()
+        if render_executor is not None:
+            # Finish in-flight renders before the document is closed
+            render_executor.shutdown(cancel_futures=True)
+        pdf_document.close()
+        if pool_source is not None:
+            cleanup_temp_files([pool_source])
+
+
+def convert_pdf_to_images(pdf_source, output_folder=None, dpi=300, return_base64=False,
+                          image_format="png", compression_level=None, quality=None,
+                          workers=None, pages=None, max_pages=None, use_cache=True,
+                          max_pixels=None, min_dpi=None, colorspace="rgb", extract_images=False,
+                          encode_workers=None, queue_depth=None):
     """
     Converts a PDF to individual images (one per page) using PyMuPDF.
     
+    Pages are rendered one at a time with iter_pdf_pages and each page is
+    encoded once; the same bytes are written to disk and base64-encoded.
+    
     Args:
-        pdf_path: Path to the PDF file
+        pdf_source: Path to the PDF file, or its content as bytes or memoryview
         output_folder: Folder to save the images (if None, images won't be saved to disk)
         dpi: Resolution for the output images (default 300)
         return_base64: Whether to return base64-encoded image data
+        image_format: Output codec, one of IMAGE_FORMATS (default "png")
+        compression_level: PNG zlib level 0-9
+        quality: JPEG/WebP quality 1-100
+        workers: Number of rendering processes (default PDF_RENDER_WORKERS)
+        pages: Page selection such as "1-3,10" (see parse_page_selection)
+        max_pages: Render at most this many of the selected pages
+        use_cache: Whether to use the render cache (default True)
+        max_pixels: Per-page pixel budget that enables adaptive DPI
+        min_dpi: Lowest DPI adaptive mode may choose
+        colorspace: "rgb" (default), "gray" or "bilevel"
+        extract_images: Pass on embedded full-page scan images as they are
+            (see iter_pdf_pages)
+        encode_workers: Threads encoding pages while the next ones render,
+            overlapping with saving and base64 work here (see iter_pdf_pages)
+        queue_depth: Pages rendered ahead when pipelining
         
     Returns:
         dict: Contains:
             - image_paths: List of paths to the generated images (if output_folder is provided)
-            - image_count: Number of pages/images
-            - image_data: List of dicts with page_number and base64-encoded image data (if return_base64=True)
+            - image_count: Number of pages in the document
+            - rendered_count: Number of pages rendered (fewer than image_count
+              when pages or max_pages is given)
+            - cache: Render cache hits and misses for this conversion
+            - image_format: Output codec used for every page
+            - colorspace: Colorspace the pages were rendered in
+            - mimetype: MIME type of the encoded images
+            - image_data: List of dicts with page_number, the dpi used, width,
+              height, format, whether the page was extracted rather than
+              rendered and base64-encoded image data (if return_base64=True)
     """
-    # Calculate zoom factor based on DPI (PyMuPDF uses 72 DPI as base)
-    zoom = dpi / 72
-    matrix = fitz.Matrix(zoom, zoom)
-    
-    # Open the PDF
-    pdf_document = fitz.open(pdf_path)
+    validate_image_format(image_format, compression_level, quality)
+    validate_colorspace(colorspace)
     
     result = {
-        "image_count": len(pdf_document)
+        "image_count": 0,
+        "rendered_count": 0,
+        "cache": {"hits": 0, "misses": 0},
+        "image_format": image_format,
+        "mimetype": IMAGE_FORMATS[image_format]["mimetype"],
+        "colorspace": colorspace,
     }
     
     image_paths = []
     image_data = []
     
-    # Process each page
-    for page_num in range(len(pdf_document)):
-        page = pdf_document.load_page(page_num)
-        
-        # Render page to pixmap (image)
-        pix = page.get_pixmap(matrix=matrix)
-        
-        # Convert to PIL Image for consistent handling
-        img_data = pix.tobytes("png")
-        pil_image = Image.open(BytesIO(img_data))
+    # Process each selected page
+    rendered_pages = iter_pdf_pages(
+        pdf_source, dpi=dpi, image_format=image_format,
+        compression_level=compression_level, quality=quality, workers=workers,
+        pages=pages, max_pages=max_pages, use_cache=use_cache,
+        max_pixels=max_pixels, min_dpi=min_dpi, colorspace=colorspace,
+        extract_images=extract_images, encode_workers=encode_workers, queue_depth=queue_depth
+    )
+    for page_number, img_data, metadata in rendered_pages:
+        result["image_count"] = metadata["page_count"]
+        result["rendered_count"] += 1
+        result["cache"]["hits" if metadata["cached"] else "misses"] += 1
         
         # Save image to disk if output_folder is provided
         if output_folder:
-            output_path = os.path.join(output_folder, f"page_{page_num + 1}.png")
-            pil_image.save(output_path, "PNG")
+            extension = IMAGE_FORMATS[metadata["format"]]["extension"]
+            output_path = os.path.join(output_folder, f"page_{page_number}{extension}")
+            with open(output_path, "wb") as image_file:
+                image_file.write(img_data)
             image_paths.append(output_path)
         
         # Generate base64-encoded data if requested
         if return_base64:
-            buffered = BytesIO()
-            pil_image.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode()
-            image_data.append({"page_number": page_num + 1, "image_data": img_str})
+            img_str = base64.b64encode(img_data).decode()
+            image_data.append({
+                "page_number": page_number,
+                "dpi": metadata["dpi"],
+                "width": metadata["width"],
+                "height": metadata["height"],
+                "format": metadata["format"],
+                "extracted": metadata["extracted"],
+                "image_data": img_str,
+            })
     
-    # Close the PDF document
-    pdf_document.close()
+    if use_cache:
+        logging.info(
+            f"Render cache: {result['cache']['hits']} hits, {result['cache']['misses']} misses "
+            f"for this document; totals {get_render_cache().stats()}"
+        )
     
     # Add image paths to result if we saved images
     if output_folder:
@@ -83,6 +851,161 @@ def convert_pdf_to_images(pdf_path, output_folder=None, dpi=300, return_base64=F
     return result
 
 
+# A page's text layer is used instead of OCR when it has at least this many
+# non-whitespace characters and at most this share of unmappable glyphs
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "50"))
+TEXT_LAYER_MAX_GARBLED_RATIO = 0.1
+
+
+def _points_to_polygon(x0, y0, x1, y1):
+    """Convert a PDF rectangle in points to a 4-point polygon in inches."""
+    x0, y0, x1, y1 = (round(value / 72, 4) for value in (x0, y0, x1, y1))
+    return [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]
+
+
+def extract_text_layer(page):
+    """
+    Reads a page's embedded text layer in reading order.
+    
+    The result mirrors the shape produced by the analyze_document function
+    (full_text, paragraphs, pages with lines and words) with coordinates in
+    inches, the unit Document Intelligence uses for PDFs. Coordinates are
+    in the rotated (displayed) frame, like the page width and height, so a
+    /Rotate 90 page and its polygons are both landscape. Line and word
+    spans point into full_text.
+    
+    Args:
+        page: PyMuPDF page
+        
+    Returns:
+        dict: Document-shaped content for the page
+    """
+    page_number = page.number + 1
+    # Text positions are unrotated; page.rect is the rotated page
+    rotation = page.rotation_matrix
+    
+    # Group words by block and line, keeping their order within each line
+    lines_by_block = {}
+    for x0, y0, x1, y1, word, block_no, line_no, _ in page.get_text("words"):
+        block_lines = lines_by_block.setdefault(block_no, {})
+        block_lines.setdefault(line_no, []).append((word, fitz.Rect(x0, y0, x1, y1) * rotation))
+    
+    paragraphs = []
+    lines = []
+    words = []
+    full_text = []
+    # Offset of the next line in full_text, where every line ends with "\n"
+    offset = 0
+    # Sorted text blocks give top-to-bottom, left-to-right reading order
+    for x0, y0, x1, y1, _, block_no, block_type in page.get_text("blocks", sort=True):
+        if block_type != 0 or block_no not in lines_by_block:
+            continue
+        
+        block_text = []
+        for line_words in lines_by_block[block_no].values():
+            line_text = " ".join(word for word, _ in line_words)
+            line_rect = fitz.Rect()
+            word_offset = offset
+            for word, rect in line_words:
+                line_rect |= rect
+                words.append({
+                    "word_index": len(words),
+                    "content": word,
+                    "confidence": 1.0,
+                    "polygon": _points_to_polygon(*rect),
+                    "spans": [{"offset": word_offset, "length": len(word)}],
+                })
+                word_offset += len(word) + 1
+            lines.append({
+                "line_index": len(lines),
+                "content": line_text,
+                "polygon": _points_to_polygon(*line_rect),
+                "spans": [{"offset": offset, "length": len(line_text)}],
+            })
+            block_text.append(line_text)
+            offset += len(line_text) + 1
+        
+        paragraphs.append({
+            "paragraph_index": len(paragraphs),
+            "content": " ".join(block_text),
+            "role": None,
+            "bounding_regions": [
+                {
+                    "page_number": page_number,
+                    "polygon": _points_to_polygon(*(fitz.Rect(x0, y0, x1, y1) * rotation)),
+                }
+            ],
+        })
+        full_text.append("\n".join(block_text))
+    
+    return {
+        "full_text": "\n".join(full_text),
+        "paragraphs": paragraphs,
+        "pages": [{
+            "page_number": page_number,
+            "width": round(page.rect.width / 72, 4),
+            "height": round(page.rect.height / 72, 4),
+            "unit": "inch",
+            "angle": page.rotation,
+            "lines": lines,
+            "words": words,
+            "selection_marks": [],
+        }],
+        "tables": [],
+    }
+
+
+def triage_pdf_pages(pdf_source, pages=None, max_pages=None, min_chars=None):
+    """
+    Decides per page whether the PDF's own text layer can replace OCR.
+    
+    Born-digital pages (and pages that were OCRed before) carry a text layer
+    that PyMuPDF reads directly; only image-only pages, or pages whose text
+    is too short or garbled, need to be rasterized and sent to Document
+    Intelligence.
+    
+    Args:
+        pdf_source: Path to the PDF file, or its content as bytes or memoryview
+        pages: Page selection such as "1-3,10" (see parse_page_selection)
+        max_pages: Triage at most this many of the selected pages
+        min_chars: Minimum non-whitespace characters for a usable text layer
+            (default TEXT_LAYER_MIN_CHARS)
+        
+    Returns:
+        list: One dict per selected page with page_number, decision
+            ("text_layer" or "ocr"), chars, garbled_ratio and elapsed_ms,
+            plus content (see extract_text_layer) for text_layer pages
+    """
+    min_chars = TEXT_LAYER_MIN_CHARS if min_chars is None else min_chars
+    pdf_document = open_pdf(pdf_source)
+    try:
+        decisions = []
+        for page_num in parse_page_selection(pages, len(pdf_document), max_pages):
+            started = time.perf_counter()
+            page = pdf_document.load_page(page_num)
+            
+            text = page.get_text("text")
+            chars = sum(1 for char in text if not char.isspace())
+            # U+FFFD marks glyphs the PDF's fonts could not map back to text
+            garbled = text.count("\ufffd")
+            garbled_ratio = round(garbled / chars, 4) if chars else 0.0
+            usable = chars >= min_chars and garbled_ratio <= TEXT_LAYER_MAX_GARBLED_RATIO
+            
+            decision = {
+                "page_number": page_num + 1,
+                "decision": "text_layer" if usable else "ocr",
+                "chars": chars,
+                "garbled_ratio": garbled_ratio,
+            }
+            if usable:
+                decision["content"] = extract_text_layer(page)
+            decision["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            decisions.append(decision)
+        return decisions
+    finally:
+        pdf_document.close()
+
+
 def save_bytes_to_temp_file(file_bytes, suffix='.pdf'):
     """Save bytes to a temporary file and return the file path."""
     temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
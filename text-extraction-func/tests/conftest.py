@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The functions import shared_code from the app root, as the Functions host does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
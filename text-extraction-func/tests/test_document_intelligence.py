@@ -0,0 +1,84 @@
+from shared_code.document_intelligence import merge_results, plan_analyses
+
+
+def layout_chunk(text, lines):
+    return {
+        "content": text,
+        "pages": [
+            {
+                "page_number": page_number,
+                "lines": [
+                    {"text": line, "bounding_regions": [{"offset": text.index(line), "length": len(line)}]}
+                    for line in page_lines
+                ],
+            }
+            for page_number, page_lines in lines
+        ],
+        "tables": [],
+    }
+
+
+def test_merge_results_rebases_spans_and_pages():
+    first = layout_chunk("alpha\nbeta", [(1, ["alpha"]), (2, ["beta"])])
+    second = layout_chunk("gamma", [(1, ["gamma"])])
+
+    merged = merge_results([([3, 4], first), ([9], second)], "content")
+
+    assert merged["content"] == "alpha\nbeta\ngamma"
+    assert [page["page_number"] for page in merged["pages"]] == [3, 4, 9]
+    for page in merged["pages"]:
+        for line in page["lines"]:
+            span = line["bounding_regions"][0]
+            assert merged["content"][span["offset"]:span["offset"] + span["length"]] == line["text"]
+
+
+def test_merge_results_renumbers_document_indexes():
+    chunk = {
+        "full_text": "text",
+        "paragraphs": [{"paragraph_index": 0, "content": "text", "spans": [{"offset": 0, "length": 4}]}],
+        "tables": [{"table_index": 0, "cells": []}],
+    }
+
+    merged = merge_results([([1], chunk), ([2], chunk)], "full_text")
+
+    assert [p["paragraph_index"] for p in merged["paragraphs"]] == [0, 1]
+    assert [t["table_index"] for t in merged["tables"]] == [0, 1]
+    assert merged["paragraphs"][1]["spans"] == [{"offset": 5, "length": 4}]
+    # The input chunks are left untouched
+    assert chunk["paragraphs"][0]["spans"] == [{"offset": 0, "length": 4}]
+
+
+def test_merge_results_skips_missing_text():
+    merged = merge_results([([1], {"content": None, "pages": []})], "content")
+    assert merged == {"content": "", "pages": []}
+
+
+def test_plan_derives_layout_from_models_with_layout():
+    assert plan_analyses(True, True, "prebuilt-document") == {
+        "calls": ["content"], "layout_from_content": True
+    }
+
+
+def test_plan_calls_layout_for_other_models():
+    for model in ("prebuilt-read", "prebuilt-receipt", "my-custom-model"):
+        assert plan_analyses(True, True, model) == {
+            "calls": ["layout", "content"], "layout_from_content": False
+        }
+
+
+def test_plan_without_derived_layout():
+    assert plan_analyses(True, True, "prebuilt-invoice", derive_layout=False) == {
+        "calls": ["layout", "content"], "layout_from_content": False
+    }
+
+
+def test_plan_single_output():
+    assert plan_analyses(True, False, "prebuilt-document") == {
+        "calls": ["layout"], "layout_from_content": False
+    }
+    assert plan_analyses(False, True, "prebuilt-document") == {
+        "calls": ["content"], "layout_from_content": False
+    }
+    assert plan_analyses(False, False, "prebuilt-document") == {
+        "calls": [], "layout_from_content": False
+    }
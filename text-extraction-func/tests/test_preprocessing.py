@@ -0,0 +1,61 @@
+import cv2
+import numpy as np
+import pytest
+from shared_code.preprocessing import compile_pipeline, encode_for_upload, preprocess_image_bytes
+
+
+def page_image():
+    """A noisy BGR page with dark text-like bars, large enough to be tiled."""
+    rng = np.random.default_rng(0)
+    image = rng.normal(220, 12, (240, 180, 3)).clip(0, 255).astype(np.uint8)
+    for top in range(20, 220, 24):
+        image[top:top + 8, 15:165] = rng.integers(0, 60, (8, 150, 3))
+    return image
+
+
+def run(spec, tile_memory_mb):
+    pipeline = compile_pipeline({"pipeline": spec, "tile_memory_mb": tile_memory_mb})
+    image = page_image()
+    if pipeline.decode_grayscale:
+        # As decode_image would have returned it
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return pipeline.run(image)
+
+
+@pytest.mark.parametrize("pipeline", [
+    [{"op": "grayscale"}, {"op": "gaussian_blur", "ksize": 5}, {"op": "threshold", "thresh": 150}],
+    [{"op": "median", "ksize": 5}, {"op": "grayscale"},
+     {"op": "adaptive_threshold", "block_size": 15, "c": 5}],
+    [{"op": "grayscale"}, {"op": "morphology", "operation": "open", "ksize": 3, "iterations": 2},
+     {"op": "canny"}, {"op": "morphology", "operation": "dilate", "ksize": 3}],
+])
+def test_tiled_pipeline_matches_whole_image(pipeline):
+    whole, _ = run(pipeline, 0)
+    tiled, timings = run(pipeline, 0.01)
+
+    assert any(timing.get("tiles", 0) > 1 for timing in timings)
+    assert np.array_equal(whole, tiled)
+
+
+@pytest.mark.parametrize("extension, image_format, mimetype", [
+    (".png", "png", "image/png"), (".jpg", "jpeg", "image/jpeg"), (".tif", "tiff", "image/tiff"),
+])
+def test_auto_passthrough_reports_input_format(extension, image_format, mimetype):
+    image = np.full((120, 90, 3), 250, np.uint8)
+    cv2.putText(image, "Hi", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+    image_bytes = cv2.imencode(extension, image)[1].tobytes()
+
+    output, report = preprocess_image_bytes(image_bytes, compile_pipeline({"pipeline": "auto"}))
+
+    assert output == image_bytes
+    assert (report["format"], report["mimetype"]) == (image_format, mimetype)
+
+
+def test_upload_scale_matches_the_returned_image():
+    image = np.random.default_rng(0).integers(0, 256, (400, 300, 3), dtype=np.uint8)
+
+    image_bytes, info = encode_for_upload(image, max_bytes=100)
+
+    assert info["over_budget"]
+    assert info["width"] == max(1, round(300 * info["scale"]))
+    assert info["height"] == max(1, round(400 * info["scale"]))
@@ -0,0 +1,56 @@
+import fitz
+import pytest
+from shared_code.utils import extract_text_layer, parse_page_selection
+
+
+def test_no_selection_is_every_page():
+    assert parse_page_selection(None, 3) == [0, 1, 2]
+    assert parse_page_selection("", 3) == [0, 1, 2]
+
+
+def test_ranges_are_sorted_and_deduplicated():
+    assert parse_page_selection("5,1-3,2", 6) == [0, 1, 2, 4]
+
+
+def test_open_ended_ranges():
+    assert parse_page_selection("4-", 6) == [3, 4, 5]
+    assert parse_page_selection("-2", 6) == [0, 1]
+
+
+def test_int_and_list_selections():
+    assert parse_page_selection(2, 3) == [1]
+    assert parse_page_selection([3, "1-2"], 3) == [0, 1, 2]
+
+
+def test_max_pages_keeps_the_first_selected_pages():
+    assert parse_page_selection("2-5", 6, max_pages=2) == [1, 2]
+    assert parse_page_selection(None, 6, max_pages=10) == [0, 1, 2, 3, 4, 5]
+
+
+@pytest.mark.parametrize("pages", ["abc", "1-x", "0", "7", "3-2", "5-7"])
+def test_invalid_selections_raise(pages):
+    with pytest.raises(ValueError):
+        parse_page_selection(pages, 6)
+
+
+def test_max_pages_must_be_positive():
+    with pytest.raises(ValueError):
+        parse_page_selection(None, 6, max_pages=0)
+
+
+@pytest.mark.parametrize("rotation", [0, 90, 180, 270])
+def test_text_layer_polygons_use_the_rotated_page_frame(rotation):
+    document = fitz.open()
+    page = document.new_page(width=612, height=792)
+    page.insert_text((72, 100), "Rotated heading", fontsize=14)
+    page.insert_text((400, 700), "footer", fontsize=9)
+    page.set_rotation(rotation)
+
+    content = extract_text_layer(page)
+    layout = content["pages"][0]
+
+    assert (layout["width"], layout["height"]) == ((11.0, 8.5) if rotation % 180 else (8.5, 11.0))
+    polygons = [line["polygon"] for line in layout["lines"]] + [word["polygon"] for word in layout["words"]]
+    for polygon in polygons:
+        for x, y in polygon:
+            assert 0 <= x <= layout["width"] and 0 <= y <= layout["height"]